@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+    benchmarks.ingest
+    ~~~~~~~~~~~~~~~~~
+    Offline ingest benchmark against a synthetic library.
+
+    Builds a library of small JSON "audio" files, opened through the opener
+    seam in owa.cli rather than mutagen, and times store_directory against a
+    throwaway SQLite database:
+
+    - cold: every file is new
+    - warm: incremental rescan of an unchanged library
+    - partial: incremental rescan after changing some files and adding an
+      album
+
+    Every scenario runs in its own process so peak memory is per scenario.
+
+    Run from the repository root::
+
+        python benchmarks/ingest.py --artists 50 --albums 4 --tracks 12
+"""
+from __future__ import print_function
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing import Process, Queue
+from time import time
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from owa import cli, config, create_app, db  # noqa
+from owa.instrument import IngestStats  # noqa
+from owa.utils import peak_rss  # noqa
+
+# seconds a scenario gets to finish before it's given up on
+SCENARIO_TIMEOUT = 3600
+
+
+class SyntheticInfo(object):
+    def __init__(self, length):
+        self.length = length
+
+
+class SyntheticFile(dict):
+    """Looks enough like an easy mutagen file for the adaptor.
+    """
+
+    def __init__(self, filename, tags, length):
+        super(SyntheticFile, self).__init__(
+            (k, v if isinstance(v, list) else [v]) for k, v in tags.items())
+        self.filename = filename
+        self.info = SyntheticInfo(length)
+
+
+def open_synthetic(filepath):
+    with io.open(filepath, encoding='utf-8') as fh:
+        data = json.load(fh)
+    return SyntheticFile(filepath, data['tags'], data['length'])
+
+
+def write_track(path, artist, album, title, genres, padding=0):
+    data = dict(tags=dict(artist=artist, album=album, title=title,
+                          genre=genres),
+                length=180 + len(title),
+                padding='.' * padding)
+    with io.open(path, 'w', encoding='utf-8') as fh:
+        fh.write(json.dumps(data, ensure_ascii=False))
+
+
+def generate_library(root, artists, albums, tracks):
+    """Writes artists * albums * tracks files under root laid out as
+    Artist/Album/NN Title.mp3
+    """
+    genres = ['death metal', 'progressive rock', 'ambient', 'jazz fusion',
+              'black metal', 'post rock', 'synth pop']
+    for a in range(artists):
+        artist = u'Artist {:04}'.format(a)
+        for b in range(albums):
+            album = u'Album {:02}'.format(b)
+            directory = os.path.join(root, artist, album)
+            os.makedirs(directory)
+            for t in range(tracks):
+                title = u'Track {:02}'.format(t)
+                path = os.path.join(directory,
+                                    u'{:02} {}.mp3'.format(t, title))
+                write_track(path, artist, album, title,
+                            [genres[a % len(genres)],
+                             genres[(a + b) % len(genres)]])
+    return artists * albums * tracks
+
+
+def change_library(root, fraction):
+    """Rewrites a fraction of the library's files and adds a new album.
+
+    :returns number of files touched:
+    """
+    paths = sorted(p for g in cli.filter_files(root) for p in g)
+    step = max(int(1 / fraction), 1) if fraction else len(paths) + 1
+    changed = 0
+    for path in paths[::step]:
+        track = open_synthetic(path)
+        write_track(path, track['artist'][0], track['album'][0],
+                    track['title'][0] + u' (Remaster)', track['genre'],
+                    padding=16)
+        changed += 1
+
+    directory = os.path.join(root, u'Artist 0000', u'Album New')
+    os.makedirs(directory)
+    for t in range(10):
+        write_track(os.path.join(directory, u'{:02} New.mp3'.format(t)),
+                    u'Artist 0000', u'Album New', u'New {:02}'.format(t),
+                    ['ambient'])
+    return changed + 10
+
+
+def _run(uri, root, options, results):
+    class BenchConfig(config.BaseConfig):
+        SQLALCHEMY_DATABASE_URI = uri
+
+    app = create_app('owa', config=BenchConfig, exts=[db])
+    stats = IngestStats()
+
+    with app.app_context():
+        db.create_all()
+        with stats.counting_queries(db.engine):
+            with contextlib.redirect_stdout(io.StringIO()):
+                cli.store_directory(root, opener=open_synthetic,
+                                    stats=stats, **options)
+
+    report = stats.report()
+    report['peak_rss'] = peak_rss()
+    results.put(report)
+
+
+def get_result(proc, results, timeout):
+    """Waits for proc to put its result on results. A process that dies
+    first, or takes longer than timeout seconds, raises a RuntimeError
+    instead of leaving the benchmark waiting forever.
+    """
+    deadline = time() + timeout
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Empty:
+            pass
+        if not proc.is_alive():
+            # whatever it put is in the pipe by the time it's gone
+            try:
+                return results.get(timeout=1)
+            except Empty:
+                raise RuntimeError('{} exited with {} without a result'
+                                   ''.format(proc.name, proc.exitcode))
+        if time() > deadline:
+            proc.terminate()
+            raise RuntimeError('{} had no result after {}s'.format(
+                proc.name, timeout))
+
+
+def run_scenario(uri, root, options):
+    """Runs store_directory in a fresh process and returns its report.
+    """
+    results = Queue()
+    proc = Process(target=_run, args=(uri, root, options, results))
+    proc.start()
+    report = get_result(proc, results, SCENARIO_TIMEOUT)
+    proc.join()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--artists', type=int, default=20)
+    parser.add_argument('--albums', type=int, default=3)
+    parser.add_argument('--tracks', type=int, default=10)
+    parser.add_argument('--change', type=float, default=0.1,
+                        help='Fraction of files changed before the partial '
+                             'rescan')
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--walkers', type=int, default=None)
+    parser.add_argument('--bulk', action='store_true', default=False)
+    parser.add_argument('--json', dest='output', default=None,
+                        help='Append a JSON line per scenario to this file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='owa-bench-')
+    root = os.path.join(workdir, 'library')
+    uri = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    options = dict(jobs=args.jobs, walkers=args.walkers, bulk=args.bulk)
+
+    try:
+        files = generate_library(root, args.artists, args.albums, args.tracks)
+        print('Generated {} files in {}'.format(files, root))
+
+        scenarios = [('cold', options, None),
+                     ('warm', dict(options, incremental=True), None),
+                     ('partial', dict(options, incremental=True),
+                      lambda: change_library(root, args.change))]
+
+        print('{:<8} {:>10} {:>12} {:>10} {:>10} {:>10}'.format(
+            'scenario', 'seconds', 'files/sec', 'parsed', 'queries',
+            'peak MB'))
+
+        output = open(args.output, 'a') if args.output else None
+        for name, opts, prepare in scenarios:
+            if prepare:
+                prepare()
+            report = run_scenario(uri, root, opts)
+            counts = report['counts']
+            print('{:<8} {:>10.3f} {:>12.1f} {:>10} {:>10} {:>10.1f}'.format(
+                name, report['elapsed'], report['files_per_second'],
+                counts.get('parsed', 0), counts.get('queries', 0),
+                (report['peak_rss'] or 0) / 1024.0 / 1024.0))
+            if output:
+                output.write(json.dumps(dict(report, scenario=name,
+                                             options=opts, files=files),
+                                        sort_keys=True) + '\n')
+        if output:
+            output.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
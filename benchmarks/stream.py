@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""
+    benchmarks.stream
+    ~~~~~~~~~~~~~~~~~
+    Load test for /stream against a synthetic library.
+
+    Builds a library with the ingest benchmark's synthetic files, pads them
+    out to a realistic size and serves them from a local app running in its
+    own process, on a fixed number of worker threads like a deployment
+    would have. Concurrent clients then pick random tracks and either
+    download them whole or seek to a random range, and the run reports:
+
+    - throughput, in requests and megabytes a second
+    - time to first byte and total latency, p50 and p99
+    - worker saturation: how many workers were busy on average, at most,
+      and for how much of the run every one of them was
+
+    --asyncio runs the asyncio stream server instead of the app, it has no
+    workers to saturate.
+
+    Run from the repository root::
+
+        python benchmarks/stream.py --clients 50 --workers 8 --duration 20
+"""
+from __future__ import division, print_function
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Event, Process, Queue
+from time import time
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest import generate_library, get_result, open_synthetic  # noqa
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler  # noqa
+from owa import cli, config, create_app, db  # noqa
+from owa.models import Track  # noqa
+from owa.stream import Stream  # noqa
+
+BLOCK_SIZE = 64 * 1024
+# seconds the server process gets to start listening, and to report back
+SERVER_TIMEOUT = 60
+
+
+class Saturation(object):
+    """WSGI middleware that keeps track of how many requests are being
+    worked on, up until their response bodies are closed.
+    """
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.peak = 0
+        self.since = self.started = time()
+        # seconds spent with n workers busy, weighted by n
+        self.busy_seconds = 0.0
+        self.saturated_seconds = 0.0
+
+    def _change(self, by):
+        with self.lock:
+            now = time()
+            elapsed = now - self.since
+            self.busy_seconds += self.busy * elapsed
+            if self.busy >= self.workers:
+                self.saturated_seconds += elapsed
+            self.since = now
+            self.busy += by
+            self.peak = max(self.peak, self.busy)
+
+    def __call__(self, environ, start_response):
+        self._change(1)
+        try:
+            body = self.app(environ, start_response)
+        except Exception:
+            self._change(-1)
+            raise
+        return _Closing(body, lambda: self._change(-1))
+
+    def report(self):
+        self._change(0)
+        elapsed = (self.since - self.started) or 1
+        return dict(workers=self.workers, peak_busy=self.peak,
+                    mean_busy=self.busy_seconds / elapsed,
+                    saturated=self.saturated_seconds / elapsed)
+
+
+class _Closing(object):
+    def __init__(self, body, callback):
+        self.body = body
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.callback()
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class PoolWSGIServer(BaseWSGIServer):
+    """Werkzeug's server with requests handled on a fixed pool of threads
+    rather than a thread each.
+    """
+
+    def __init__(self, host, port, app, workers):
+        BaseWSGIServer.__init__(self, host, port, app, handler=QuietHandler)
+        self.pool = ThreadPoolExecutor(workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def build_library(root, uri, artists, albums, tracks, size):
+    """Generates and stores a synthetic library, then pads every file out
+    to size bytes.
+
+    :returns [stream id]:
+    """
+    generate_library(root, artists, albums, tracks)
+
+    class BenchConfig(config.BaseConfig):
+        SQLALCHEMY_DATABASE_URI = uri
+
+    app = create_app('owa', config=BenchConfig, exts=[db])
+    with app.app_context():
+        db.create_all()
+        with contextlib.redirect_stdout(io.StringIO()):
+            cli.store_directory(root, opener=open_synthetic)
+        streams = db.session.query(Track.uuid, Track.location).all()
+
+    block = os.urandom(BLOCK_SIZE)
+    for _, location in streams:
+        with open(location, 'ab') as fh:
+            left = size - fh.tell()
+            while left > 0:
+                fh.write(block[:left])
+                left -= BLOCK_SIZE
+
+    return [uuid for uuid, _ in streams]
+
+
+def _serve(uri, port, workers, use_asyncio, ready, stop, results):
+    class BenchConfig(config.BaseConfig):
+        SQLALCHEMY_DATABASE_URI = uri
+
+    app = create_app('owa', config=BenchConfig, exts=[db], bps=[Stream])
+
+    @app.teardown_request
+    def remove_session(exc):
+        db.session.remove()
+
+    if use_asyncio:
+        runner = threading.Thread(target=_serve_asyncio,
+                                  args=(app, port, workers, ready))
+        middleware = None
+    else:
+        middleware = Saturation(app.wsgi_app, workers)
+        app.wsgi_app = middleware
+        # listening as soon as it's made
+        server = PoolWSGIServer('127.0.0.1', port, app, workers)
+        runner = threading.Thread(target=server.serve_forever)
+        ready.set()
+
+    runner.daemon = True
+    runner.start()
+    stop.wait()
+    results.put(middleware.report() if middleware else None)
+
+
+def _serve_asyncio(app, port, workers, ready):
+    # StreamServer.run, but ready is only set once the socket is bound
+    import asyncio
+    from owa.streamserver import MAX_HEADERS, StreamServer
+    server = StreamServer(app, lookups=workers)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(asyncio.start_server(
+        server.handle, '127.0.0.1', port, limit=MAX_HEADERS))
+    ready.set()
+    loop.run_forever()
+
+
+def wait_until_ready(proc, ready, timeout=SERVER_TIMEOUT):
+    """Waits for the server process to start listening. One that dies
+    first, or doesn't listen within timeout seconds, raises a RuntimeError.
+    """
+    deadline = time() + timeout
+    while not ready.wait(1):
+        if not proc.is_alive():
+            raise RuntimeError('server exited with {} before listening'
+                               ''.format(proc.exitcode))
+        if time() > deadline:
+            proc.terminate()
+            raise RuntimeError('server not listening after {}s'.format(
+                timeout))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def client(port, streams, size, until, seek_ratio, range_size, samples):
+    """Requests random streams until the deadline, recording a
+    (kind, ttfb, latency, bytes, ok) sample for each request.
+    """
+    conn = HTTPConnection('127.0.0.1', port, timeout=60)
+    while time() < until:
+        headers = {}
+        kind = 'full'
+        if random.random() < seek_ratio:
+            kind = 'range'
+            start = random.randrange(0, max(size - range_size, 1))
+            headers['Range'] = 'bytes={}-{}'.format(start,
+                                                    start + range_size - 1)
+
+        began = time()
+        try:
+            conn.request('GET', '/stream/' + random.choice(streams),
+                         headers=headers)
+            response = conn.getresponse()
+            first = time()
+            received = 0
+            for chunk in iter(lambda: response.read(BLOCK_SIZE), b''):
+                received += len(chunk)
+            ok = response.status in (200, 206)
+        except (IOError, OSError):
+            conn.close()
+            conn = HTTPConnection('127.0.0.1', port, timeout=60)
+            samples.append((kind, None, time() - began, 0, False))
+            continue
+        samples.append((kind, first - began, time() - began, received, ok))
+    conn.close()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def summarize(samples, elapsed):
+    good = [s for s in samples if s[4]]
+    report = dict(requests=len(samples), errors=len(samples) - len(good),
+                  seconds=elapsed,
+                  requests_per_second=len(good) / elapsed,
+                  megabytes_per_second=sum(s[3] for s in good) /
+                  elapsed / 1024 / 1024)
+    for kind in ('full', 'range'):
+        ttfb = [s[1] for s in good if s[0] == kind]
+        latency = [s[2] for s in good if s[0] == kind]
+        report[kind] = dict(requests=len(latency),
+                            ttfb_p50=percentile(ttfb, 50),
+                            ttfb_p99=percentile(ttfb, 99),
+                            latency_p50=percentile(latency, 50),
+                            latency_p99=percentile(latency, 99))
+    return report
+
+
+def _ms(seconds):
+    return '-' if seconds is None else '{:.1f}'.format(seconds * 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--artists', type=int, default=5)
+    parser.add_argument('--albums', type=int, default=2)
+    parser.add_argument('--tracks', type=int, default=5)
+    parser.add_argument('--size', type=float, default=2,
+                        help='Size of every file in megabytes')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Worker threads serving the app')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds to run for')
+    parser.add_argument('--seek-ratio', dest='seek_ratio', type=float,
+                        default=0.5,
+                        help='Fraction of requests that ask for a range')
+    parser.add_argument('--range-size', dest='range_size', type=int,
+                        default=256 * 1024)
+    parser.add_argument('--asyncio', dest='use_asyncio', action='store_true',
+                        default=False,
+                        help='Load the asyncio stream server instead')
+    parser.add_argument('--json', dest='output', default=None,
+                        help='Append a JSON line with the results to this '
+                             'file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='owa-bench-')
+    root = os.path.join(workdir, 'library')
+    uri = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    size = int(args.size * 1024 * 1024)
+
+    try:
+        streams = build_library(root, uri, args.artists, args.albums,
+                                args.tracks, size)
+        print('Generated {} files of {:.1f}MB in {}'.format(
+            len(streams), args.size, root))
+
+        port = free_port()
+        ready, stop, results = Event(), Event(), Queue()
+        server = Process(target=_serve,
+                         args=(uri, port, args.workers, args.use_asyncio,
+                               ready, stop, results))
+        server.start()
+        wait_until_ready(server, ready)
+
+        samples = []
+        started = time()
+        until = started + args.duration
+        threads = [threading.Thread(target=client,
+                                    args=(port, streams, size, until,
+                                          args.seek_ratio, args.range_size,
+                                          samples))
+                   for _ in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time() - started
+
+        stop.set()
+        saturation = get_result(server, results, SERVER_TIMEOUT)
+        server.join()
+
+        report = summarize(samples, elapsed)
+        report['saturation'] = saturation
+
+        print('{} clients, {} for {:.1f}s: {} requests, {} errors'.format(
+            args.clients,
+            'asyncio' if args.use_asyncio else
+            '{} workers'.format(args.workers),
+            elapsed, report['requests'], report['errors']))
+        print('{:.1f} requests/sec, {:.1f} MB/sec'.format(
+            report['requests_per_second'], report['megabytes_per_second']))
+        print('{:<6} {:>9} {:>10} {:>10} {:>10} {:>10}'.format(
+            'kind', 'requests', 'ttfb p50', 'ttfb p99', 'p50 ms', 'p99 ms'))
+        for kind in ('full', 'range'):
+            r = report[kind]
+            print('{:<6} {:>9} {:>10} {:>10} {:>10} {:>10}'.format(
+                kind, r['requests'], _ms(r['ttfb_p50']), _ms(r['ttfb_p99']),
+                _ms(r['latency_p50']), _ms(r['latency_p99'])))
+        if saturation:
+            print('workers busy: {:.1f} on average, {} at most, all {} busy '
+                  '{:.0%} of the time'.format(
+                      saturation['mean_busy'], saturation['peak_busy'],
+                      saturation['workers'], saturation['saturated']))
+
+        if args.output:
+            with open(args.output, 'a') as output:
+                output.write(json.dumps(dict(report, options=vars(args)),
+                                        sort_keys=True) + '\n')
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
 import sys
 from flask.ext.migrate import Migrate, MigrateCommand
 from flask.ext.script import Manager
@@ -19,14 +20,18 @@ from owa import (
 
 from owa.api import api
 from owa.stream import Stream
+from owa.download import Download
 from owa.cli import store_directory
+from owa.instrument import IngestStats
+from owa.watch import watch as watch_library
+from owa.reconcile import reconcile as reconcile_library
 
 import pynads
 
 app = create_app('owa',
                  config=config.DevConfig,
                  exts=[db, api],
-                 bps=[Stream],
+                 bps=[Stream, Download],
                  after=after_request)
 manager = Manager(app)
 migrate = Migrate(app, db)
@@ -35,14 +40,85 @@ manager.add_command('db', MigrateCommand)
 
 
 @manager.option('-d', '--d', dest='basedir')
-def addfiles(basedir):
+@manager.option('-j', '--jobs', dest='jobs', type=int, default=None,
+                help='Number of processes to parse tags with')
+@manager.option('-i', '--incremental', dest='incremental', action='store_true',
+                default=False, help='Only read new or changed files')
+@manager.option('-b', '--bulk', dest='bulk', action='store_true',
+                default=False, help='Store with set based inserts')
+@manager.option('-c', '--cache', dest='cache', default=None,
+                help='Path to a tag cache to read through')
+@manager.option('-l', '--lean', dest='lean', action='store_true',
+                default=False, help='Keep memory use flat on huge libraries')
+@manager.option('--journal', dest='journal', default='owa_ingest.journal',
+                help='Where to record committed directories')
+@manager.option('-r', '--resume', dest='resume', action='store_true',
+                default=False,
+                help='Pick up where an interrupted run left off')
+@manager.option('-w', '--walkers', dest='walkers', type=int, default=None,
+                help='Number of threads to list directories with')
+@manager.option('-s', '--stats', dest='stats', default=None,
+                help='Write JSON lines of timings and counts to this file')
+def addfiles(basedir, jobs, incremental, bulk, cache, lean, journal, resume,
+             walkers, stats):
+    output = open(stats, 'a') if stats else None
     try:
-        store_directory(basedir)
+        store_directory(basedir, jobs=jobs, incremental=incremental,
+                        bulk=bulk, cache=cache, lean=lean, journal=journal,
+                        resume=resume, walkers=walkers,
+                        stats=IngestStats(output=output))
     except (KeyboardInterrupt, EOFError):
         db.session.rollback()
         sys.exit(1)
     else:
         sys.exit(0)
+    finally:
+        if output:
+            output.close()
+
+
+@manager.option('-d', '--d', dest='basedirs', action='append')
+@manager.option('-s', '--settle', dest='settle', type=float, default=2,
+                help='Seconds to wait for changes to settle down')
+@manager.option('-p', '--poll', dest='polling', action='store_true',
+                default=False, help='Poll directories even if inotify works')
+@manager.option('-n', '--interval', dest='interval', type=float, default=5,
+                help='Seconds between polls')
+@manager.option('-b', '--bulk', dest='bulk', action='store_true',
+                default=False, help='Store with set based inserts')
+def watch(basedirs, settle, polling, interval, bulk):
+    try:
+        watch_library(basedirs, settle=settle, interval=interval,
+                      polling=polling, bulk=bulk)
+    except (KeyboardInterrupt, EOFError):
+        db.session.rollback()
+        sys.exit(0)
+
+
+@manager.option('-d', '--d', dest='basedirs', action='append')
+@manager.option('--prune', dest='prune', action='store_true', default=False,
+                help='Remove tracks whose files can not be found')
+def reconcile(basedirs, prune):
+    try:
+        reconcile_library(basedirs, prune=prune)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    except (KeyboardInterrupt, EOFError):
+        db.session.rollback()
+        sys.exit(1)
+    else:
+        sys.exit(0)
+
+
+@manager.option('-H', '--host', dest='host', default='127.0.0.1')
+@manager.option('-p', '--port', dest='port', type=int, default=5001)
+@manager.option('-t', '--lookups', dest='lookups', type=int, default=4,
+                help='Number of threads to look stream ids up with')
+def streamserver(host, port, lookups):
+    # asyncio needs Python 3.5+, so this isn't imported along with the rest
+    from owa.streamserver import StreamServer
+    StreamServer(app, lookups=lookups).run(host=host, port=port)
 
 
 @manager.shell
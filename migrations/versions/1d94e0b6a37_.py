@@ -0,0 +1,82 @@
+"""empty message
+
+Revision ID: 1d94e0b6a37
+Revises: 5a7c3d20e1f
+Create Date: 2026-10-18 16:05:39.702215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d94e0b6a37'
+down_revision = '5a7c3d20e1f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+album = sa.table('album', sa.column('id'), sa.column('name'),
+                 sa.column('artist_id'))
+tracklists = sa.table('tracklists', sa.column('id'))
+positions = sa.table('trackpositions', sa.column('id'),
+                     sa.column('position'), sa.column('track_id'),
+                     sa.column('tracklist_id'))
+
+
+def merge_duplicate_albums(conn):
+    """Nothing stopped the same album from being stored twice for an artist
+    before this. Duplicates are merged into the oldest copy, their tracks
+    are appended to it unless it has them already, so the constraint can be
+    added to a populated database.
+    """
+    duplicated = conn.execute(
+        sa.select([album.c.name, album.c.artist_id, sa.func.min(album.c.id)])
+        .where(sa.and_(album.c.name.isnot(None),
+                       album.c.artist_id.isnot(None)))
+        .group_by(album.c.name, album.c.artist_id)
+        .having(sa.func.count(album.c.id) > 1)).fetchall()
+
+    for name, artist_id, keep in duplicated:
+        copies = [id for id, in conn.execute(
+            sa.select([album.c.id])
+            .where(sa.and_(album.c.name == name,
+                           album.c.artist_id == artist_id,
+                           album.c.id != keep))
+            .order_by(album.c.id))]
+        kept = set(track_id for track_id, in conn.execute(
+            sa.select([positions.c.track_id])
+            .where(positions.c.tracklist_id == keep)))
+        last = conn.execute(sa.select([sa.func.max(positions.c.position)])
+                            .where(positions.c.tracklist_id == keep)).scalar()
+        position = -1 if last is None else last
+
+        for copy in copies:
+            moving = conn.execute(
+                sa.select([positions.c.id, positions.c.track_id])
+                .where(positions.c.tracklist_id == copy)
+                .order_by(positions.c.position)).fetchall()
+            for id, track_id in moving:
+                if track_id in kept:
+                    conn.execute(positions.delete()
+                                 .where(positions.c.id == id))
+                    continue
+                position += 1
+                kept.add(track_id)
+                conn.execute(positions.update()
+                             .where(positions.c.id == id)
+                             .values(tracklist_id=keep, position=position))
+            conn.execute(album.delete().where(album.c.id == copy))
+            conn.execute(tracklists.delete().where(tracklists.c.id == copy))
+
+
+def upgrade():
+    merge_duplicate_albums(op.get_bind())
+    ### commands auto generated by Alembic - please adjust! ###
+    op.create_unique_constraint('uq_album_name_artist_id', 'album',
+                                ['name', 'artist_id'])
+    ### end Alembic commands ###
+
+
+def downgrade():
+    ### commands auto generated by Alembic - please adjust! ###
+    op.drop_constraint('uq_album_name_artist_id', 'album', type_='unique')
+    ### end Alembic commands ###
@@ -0,0 +1,181 @@
+"""
+    openwebamp.bulk
+    ~~~~~~~~~~~~~~~
+    Set based storage for parsed track information.
+
+    shove_into_models builds and flushes every Artist, Album, Track and
+    ArtistTag one object at a time. The functions here store a whole batch of
+    adaptor output with a handful of queries per entity instead, producing the
+    same rows the ORM path does.
+"""
+from uuid import uuid4
+from sqlalchemy import func
+from .core import break_tag, location_hash
+from .models import (db, bump_revision, refresh_counters, Album, Artist,
+                     ArtistTag, Tag, Track, TrackPosition)
+from .utils import chunked
+
+
+def _resolve_names(session, model, names):
+    """Finds or creates rows for a model that's unique by name.
+
+    :returns ({name: id}, number of rows created):
+    """
+    names = set(names)
+    found = {}
+
+    def lookup(wanted):
+        for chunk in chunked(wanted):
+            rows = session.query(model.name, model.id)\
+                .filter(model.name.in_(chunk))
+            found.update(rows)
+
+    lookup(names)
+    missing = names - set(found)
+
+    if missing:
+        session.execute(model.__table__.insert(),
+                        [{'name': name} for name in missing])
+        lookup(missing)
+
+    return found, len(missing)
+
+
+def _resolve_albums(session, keys):
+    """Finds or creates albums for (name, artist_id) pairs.
+
+    :returns ({(name, artist_id): id}, number of albums created):
+    """
+    keys = set(keys)
+    found = {}
+
+    for chunk in chunked({artist_id for _, artist_id in keys}):
+        rows = session.query(Album.name, Album.artist_id, Album.id)\
+            .filter(Album.artist_id.in_(chunk))
+        found.update(((name, artist_id), id) for name, artist_id, id in rows
+                     if (name, artist_id) in keys)
+
+    missing = [dict(name=name, artist_id=artist_id,
+                    type=Album.__mapper__.polymorphic_identity)
+               for name, artist_id in keys - set(found)]
+
+    if missing:
+        # joined inheritance needs the tracklist id before the album row
+        # can be written, return_defaults fetches it for us
+        session.bulk_insert_mappings(Album, missing, return_defaults=True)
+        found.update(((m['name'], m['artist_id']), m['id']) for m in missing)
+
+    return found, len(missing)
+
+
+def _tag_artists(session, pairs):
+    """Creates ArtistTag rows for (artist_id, tag_id) pairs that don't exist.
+    """
+    pairs = set(pairs)
+
+    for chunk in chunked({artist_id for artist_id, _ in pairs}):
+        rows = session.query(ArtistTag.artist_id, ArtistTag.tag_id)\
+            .filter(ArtistTag.artist_id.in_(chunk))
+        pairs.difference_update(rows)
+
+    if pairs:
+        session.execute(ArtistTag.__table__.insert(),
+                        [{'artist_id': a, 'tag_id': t} for a, t in pairs])
+    return len(pairs)
+
+
+def _next_positions(session, tracklist_ids):
+    """Finds where the next track appended to each tracklist will go.
+    """
+    positions = dict.fromkeys(tracklist_ids, 0)
+
+    for chunk in chunked(positions):
+        rows = session.query(TrackPosition.tracklist_id,
+                             func.count(TrackPosition.id))\
+            .filter(TrackPosition.tracklist_id.in_(chunk))\
+            .group_by(TrackPosition.tracklist_id)
+        positions.update(rows)
+
+    return positions
+
+
+def bulk_store(infos, session=None):
+    """Stores a batch of adaptor output, like shove_into_models does for a
+    single track. Tracks are expected to be new, the caller is responsible
+    for filtering out locations that are already stored.
+
+    :param infos: Iterable of dictionaries produced by the adaptor
+    :param session: Session to write with, defaults to db.session
+    :returns dict: Count of rows inserted, keyed by table name
+    """
+    session = session or db.session
+    infos = list(infos)
+
+    if not infos:
+        return {}
+
+    artists, new_artists = _resolve_names(session, Artist,
+                                          (i['artist'] for i in infos))
+
+    tag_names = {}
+    for info in infos:
+        broken = tag_names.setdefault(info['artist'], set())
+        for composite in info['tags']:
+            broken.update(break_tag(composite))
+
+    tags, new_tags = _resolve_names(session, Tag,
+                                    set().union(*tag_names.values()))
+
+    artist_tags = _tag_artists(session, (
+        (artists[artist], tags[tag])
+        for artist, names in tag_names.items()
+        for tag in names))
+
+    albums, new_albums = _resolve_albums(session, (
+        (i['album'], artists[i['artist']]) for i in infos))
+
+    tracks = []
+    for info in infos:
+        tracks.append(dict(
+            artist_id=artists[info['artist']],
+            length=info['length'],
+            location=info['location'],
+            location_hash=location_hash(info['location']),
+            name=info['name'],
+            uuid=str(uuid4()),
+            size=info.get('size'),
+            mtime=info.get('mtime'),
+            inode=info.get('inode'),
+            fingerprint=info.get('fingerprint'),
+            _album=albums[(info['album'], artists[info['artist']])]))
+
+    session.execute(Track.__table__.insert(),
+                    [{k: v for k, v in t.items() if k != '_album'}
+                     for t in tracks])
+
+    ids = {}
+    for chunk in chunked([t['uuid'] for t in tracks]):
+        ids.update(session.query(Track.uuid, Track.id)
+                   .filter(Track.uuid.in_(chunk)))
+
+    positions = _next_positions(session, {t['_album'] for t in tracks})
+    track_positions = []
+    for track in tracks:
+        tracklist_id = track['_album']
+        track_positions.append(dict(track_id=ids[track['uuid']],
+                                    tracklist_id=tracklist_id,
+                                    position=positions[tracklist_id]))
+        positions[tracklist_id] += 1
+
+    session.execute(TrackPosition.__table__.insert(), track_positions)
+    refresh_counters(session, list(positions))
+    bump_revision(session)
+
+    rows = {Artist.__table__.name: new_artists, Tag.__table__.name: new_tags,
+            ArtistTag.__table__.name: artist_tags,
+            Track.__table__.name: len(tracks),
+            TrackPosition.__table__.name: len(track_positions)}
+    # an album is a row in both tracklists and album
+    for table in Album.__mapper__.tables:
+        rows[table.name] = new_albums
+    return rows
@@ -1,14 +1,36 @@
 from __future__ import print_function
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import sha1
+from multiprocessing import Pool
 from time import time
-from mutagenx import File
 from sqlalchemy.exc import IntegrityError
 from . import shell
+from .compat import scandir
+from .bulk import bulk_store
+from .core import location_hash
+from .instrument import IngestStats
+from .journal import Journal
 from .models import db, Artist, Track, Album
+from .stream import forget_streams
+from .tagcache import open_cache
+from .utils import chunked, peak_rss, release_session
 
+# only needed to read real audio files, stores given their own opener (like
+# the ingest benchmark's) work without it
+try:
+    from mutagenx import File
+except ImportError:
+    File = None
 
 valid_file_exts = ('m4a', 'flac', 'mp3', 'ogg', 'oga')
+# groups handed to the parsing pool per worker before waiting on results
+IN_FLIGHT = 2
+# files stored, and committed, together by a bulk import
+BULK_BATCH = 500
 
 
 def filter_files(basedir, valid_exts=valid_file_exts):
@@ -32,11 +54,16 @@ def filter_files(basedir, valid_exts=valid_file_exts):
 
     And so on.
 
+    Directories are walked in sorted order, so walking the same tree twice
+    yields the same groups in the same order.
+
     :param basedir: Absolute or relative path to directory to walk.
     :param valid_exts: Iterable of extensions to match against
     :yields [AbsolutePath]:
     """
-    for current, _, files in os.walk(basedir):
+    for current, dirs, files in os.walk(basedir):
+        # sorting in place makes os.walk visit directories in a stable order
+        dirs.sort()
         files = sorted(files)
         matched = [f for f in files if f.endswith(valid_exts)]
         full_paths = [os.path.join(current, f) for f in matched]
@@ -45,6 +72,96 @@ def filter_files(basedir, valid_exts=valid_file_exts):
             yield full_paths
 
 
+class ParsedGroup(list):
+    """The (filepath, info, error) results of parsing a group, along with
+    how long parsing took and counts of what happened to each file. Those
+    survive being sent back from a worker process.
+    """
+
+    def __init__(self, results=(), seconds=0, counts=None):
+        super(ParsedGroup, self).__init__(results)
+        self.seconds = seconds
+        self.counts = counts or {}
+
+
+class ScannedGroup(list):
+    """A group of file paths that also carries the stat results gathered
+    while the directory was listed, keyed by path.
+    """
+
+    def __init__(self, paths, stats):
+        super(ScannedGroup, self).__init__(paths)
+        self.stats = stats
+
+
+def _list_directory(directory, valid_exts):
+    """Lists a single directory, stat'ing matching files as it goes.
+
+    :returns (ScannedGroup or None, [subdirectory]): The group is None if
+    the directory doesn't hold any files at all.
+    """
+    files, subdirs, stats = [], [], {}
+
+    try:
+        entries = list(scandir(directory))
+    except OSError:
+        return None, []
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+        else:
+            files.append(entry)
+
+    matched = sorted((e for e in files if e.name.endswith(valid_exts)),
+                     key=lambda e: e.name)
+    for entry in matched:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        stats[entry.path] = dict(size=stat.st_size, mtime=int(stat.st_mtime),
+                                 inode=stat.st_ino)
+
+    group = ScannedGroup([e.path for e in matched], stats) if files else None
+    return group, sorted(subdirs)
+
+
+def scan_files(basedir, valid_exts=valid_file_exts, threads=8):
+    """A drop in for filter_files that lists directories from a pool of
+    threads, which hides the round trip for every listing on network
+    mounts. Groups are yielded in the same order filter_files yields them,
+    as soon as they're ready, while the rest of the tree is still being
+    listed.
+
+    The stat results for matched files are kept on each group so that
+    checking them against the manifest doesn't stat them a second time.
+
+    :param basedir: Directory to walk
+    :param valid_exts: Iterable of extensions to match against
+    :param threads: Number of directories to list at once
+    :yields ScannedGroup:
+    """
+    if scandir is None:
+        raise RuntimeError('scan_files needs os.scandir or the scandir '
+                           'package')
+
+    pool = ThreadPoolExecutor(threads)
+    pending = [pool.submit(_list_directory, basedir, valid_exts)]
+    try:
+        while pending:
+            group, subdirs = pending.pop().result()
+            # reversed so the first subdirectory is next off the stack
+            pending.extend(pool.submit(_list_directory, d, valid_exts)
+                           for d in reversed(subdirs))
+            if group is not None:
+                yield group
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
 def adaptor(track):
     """Adapts a Mutagen/MutagenX file object to a dictionary for easier
     handling. Extracts and manipulates specific information.
@@ -69,6 +186,230 @@ def adaptor(track):
         tags=tags)
 
 
+def file_stats(filepath):
+    """Gathers the stat information stored alongside a track that's used to
+    tell if a file has changed since it was last read.
+    """
+    stat = os.stat(filepath)
+    return dict(size=stat.st_size, mtime=int(stat.st_mtime),
+                inode=stat.st_ino)
+
+
+def fingerprint(filepath, block=65536):
+    """Builds a cheap content fingerprint for a file out of its size and its
+    first and last blocks. Tags usually live at one end of the file or the
+    other and the audio data in the middle rarely changes without the size
+    changing too, so this is enough to recognize a file that's been moved.
+
+    :param filepath: File to fingerprint
+    :param block: Number of bytes to read from each end
+    """
+    size = os.path.getsize(filepath)
+    digest = sha1(str(size).encode('ascii'))
+
+    with open(filepath, 'rb') as fh:
+        digest.update(fh.read(block))
+        if size > block:
+            fh.seek(max(block, size - block))
+            digest.update(fh.read(block))
+
+    return digest.hexdigest()
+
+
+def load_manifest(session=None, locations=None):
+    """Loads the stat information of stored tracks keyed by the hash of
+    their location. Only columns are selected, no Track objects are built.
+
+    :param session: Session to query with, defaults to db.session
+    :param locations: Only load these locations rather than every track
+    :returns {location_hash: (size, mtime, inode)}:
+    """
+    session = session or db.session
+    query = session.query(Track.location_hash, Track.size,
+                          Track.mtime, Track.inode)
+
+    if locations is None:
+        chunks = [query]
+    else:
+        chunks = (query.filter(Track.location_hash.in_(
+            [location_hash(location) for location in chunk]))
+            for chunk in chunked(locations))
+
+    return {key: (size, mtime, inode)
+            for rows in chunks
+            for key, size, mtime, inode in rows}
+
+
+def is_unchanged(filepath, manifest, stats=None):
+    """Checks a file against the manifest using at most a stat call.
+
+    :param stats: Stat results for the file if they're already known
+    """
+    known = manifest.get(location_hash(filepath))
+    if known is None:
+        return False
+    stats = stats or file_stats(filepath)
+    return known == (stats['size'], stats['mtime'], stats['inode'])
+
+
+def skip_unchanged(groups, manifest):
+    """Removes files from each group that haven't changed since they were
+    last stored, before anything has to open them.
+    """
+    for group in groups:
+        stats = getattr(group, 'stats', {})
+        yield [f for f in group
+               if not is_unchanged(f, manifest, stats.get(f))]
+
+
+def open_file(filepath):
+    """Opens an audio file with mutagen's easy interface.
+    """
+    if File is None:
+        raise RuntimeError('reading audio files needs mutagenx')
+    return File(filepath, easy=True)
+
+
+def _describe(error):
+    return 'Error {0!s}: {1!s}'.format(error.__class__.__name__, error)
+
+
+def parse_group(group, adaptor=adaptor, cache=None, opener=open_file):
+    """Opens every file in a group with mutagen and runs it through the
+    adaptor. Nothing here touches the database, so this is safe to run in a
+    worker process.
+
+    :param group: Iterable of file paths, as yielded by filter_files
+    :param adaptor: Callable that transforms a mutagen file into a dict
+    :param cache: Path to a TagCache consulted before opening each file,
+    anything that has to be parsed is added to it
+    :param opener: Callable that opens a file path into something the
+    adaptor understands
+    :returns ParsedGroup: One (filepath, info, error) entry per file in the
+    group, either info or error will be None. A file that can't be read,
+    like one that's only half copied, gets an error rather than failing the
+    whole group.
+    """
+    started = time()
+    tag_cache = open_cache(cache) if cache else None
+    parsed, misses = ParsedGroup(), []
+    counts = dict(parsed=0, cache_hits=0, failed=0)
+    for filepath in group:
+        try:
+            stats = file_stats(filepath)
+        except OSError as e:
+            # gone since the directory was listed
+            parsed.append((filepath, None, _describe(e)))
+            counts['failed'] += 1
+            continue
+
+        if tag_cache:
+            hit = tag_cache.get(filepath, stats['size'], stats['mtime'])
+            if hit:
+                info, error = hit
+                if info is not None:
+                    info['inode'] = stats['inode']
+                else:
+                    counts['failed'] += 1
+                counts['cache_hits'] += 1
+                parsed.append((filepath, info, error))
+                continue
+
+        counts['parsed'] += 1
+
+        # mutagen's errors for broken files don't share a base class
+        try:
+            track = opener(filepath)
+            if track is None:
+                raise ValueError('not a recognized audio file')
+            info = adaptor(track)
+            info.update(stats)
+            info['fingerprint'] = fingerprint(filepath)
+        except Exception as e:
+            info = None
+            error = _describe(e)
+            counts['failed'] += 1
+        else:
+            error = None
+
+        parsed.append((filepath, info, error))
+        misses.append((filepath, stats['size'], stats['mtime'], info, error))
+
+    if tag_cache and misses:
+        tag_cache.put_many(misses)
+
+    parsed.seconds = time() - started
+    parsed.counts = counts
+    return parsed
+
+
+def parse_groups(groups, adaptor=adaptor, jobs=None, cache=None,
+                 opener=open_file):
+    """Parses groups of files either in process or across a pool of
+    worker processes, yielding the results in the same order the groups
+    were provided.
+
+    The adaptor and opener must be picklable (module level functions, for
+    example) when jobs is greater than one. At most IN_FLIGHT groups per job
+    are handed to the pool ahead of the one being waited on, so parsed groups
+    don't pile up in memory while the database falls behind.
+
+    :param groups: Iterable of file path groups
+    :param adaptor: Callable that transforms a mutagen file into a dict
+    :param jobs: Number of worker processes to use, None or 1 parses in
+    the current process.
+    :param cache: Path to a TagCache to read through
+    :param opener: Callable that opens a file path for the adaptor
+    """
+    parser = partial(parse_group, adaptor=adaptor, cache=cache,
+                     opener=opener)
+
+    if not jobs or jobs < 2:
+        for group in groups:
+            yield parser(group)
+        return
+
+    pool = Pool(jobs)
+    pending = deque()
+    try:
+        for group in groups:
+            pending.append(pool.apply_async(parser, (group,)))
+            if len(pending) >= jobs * IN_FLIGHT:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def batched_groups(groups, size=BULK_BATCH):
+    """Joins consecutive parsed groups into batches of at least size files.
+    A set based store costs about the same whatever the number of tracks, so
+    storing one directory at a time leaves most of its gain on the table.
+    Each batch keeps the groups it was made from in its groups attribute,
+    so they can still be checkpointed one directory at a time.
+
+    :returns iterator of ParsedGroup:
+    """
+    batch = None
+    for group in groups:
+        if batch is None:
+            batch = ParsedGroup()
+            batch.groups = []
+        batch.extend(group)
+        batch.groups.append(group)
+        batch.seconds += getattr(group, 'seconds', 0)
+        for name, amount in getattr(group, 'counts', {}).items():
+            batch.counts[name] = batch.counts.get(name, 0) + amount
+        if len(batch) >= size:
+            yield batch
+            batch = None
+    if batch is not None:
+        yield batch
+
+
 def shove_into_models(data):
     """Take a dictionary and convert it to models.
     """
@@ -94,54 +435,250 @@ def shove_into_models(data):
     return artist, album, track, tags
 
 
-def store_directory(basedir, valid_exts=valid_file_exts, adaptor=adaptor):
-    total_time = time()
-    total_count = 0
-    print('Begining walk of {}'.format(basedir))
-    for group in filter_files(basedir, valid_exts):
-        start = time()
-        art, alb, trk, tags = [False] * 4
-        for filepath in group:
+def refresh_track(track, data):
+    """Updates a previously stored track with information from a file that
+    has changed on disk.
+    """
+    info = {k: v for k, v in data.items()}
+    artist = Artist.find_or_create(db.session, name=info['artist'])
+    album = Album.find_or_create(db.session, name=info['album'],
+                                 artist=artist)
+
+    tags, success = shell.apply_tags_to_artist(info, artist)
+    if not success:
+        tags = []
 
-            track = File(filepath, easy=True)
+    track.artist = artist
+    for field in ('name', 'length', 'size', 'mtime', 'inode', 'fingerprint'):
+        setattr(track, field, info[field])
+    move_to_album(track, album)
+    forget_streams([track.uuid])
 
-            try:
-                info = adaptor(track)
-            except KeyError as e:
-                print('Error processing: {}'.format(track.filename),
-                      'Error {0!s}: {1!s}'.format(e.__class__.__name__, e),
-                      sep='\n', file=sys.stderr)
-                continue
+    db.session.add_all([artist, album, track])
+    db.session.add_all(tags)
+    return artist, track, tags
 
-            if Track.query.filter_by(location=info['location']).first():
-                print('{} previously processed, skipping'.format(info['name']))
-                continue
 
-            art, alb, trk, tags = shove_into_models(info)
-            tag_str = ', '.join([t.name for t in tags])
-            print(
-                '* Processed: {0.name} - {1.name} - {2.name}'
-                '\n    With Tags: {3}'.format(art, alb, trk, tag_str),
-                sep='\n', file=sys.stdout)
-        try:
-            db.session.commit()
-            total_count += len(group)
-        except IntegrityError as e:
-            db.session.rollback()
-            print('***Error encountered: {!s}'.format(e),
-                  '  Artist: {}'.format(art.name),
-                  '  Album: {}'.format(alb.name),
-                  '  Track: {}'.format(trk.name),
+def move_to_album(track, album):
+    """Moves a track onto album if it isn't already there, taking it off
+    whichever album it was on before, whose tracks are then renumbered.
+    Playlists the track is on are left alone.
+    """
+    positions = [p for p in track._tracklists
+                 if isinstance(p.tracklist, Album)]
+    if any(p.tracklist is album for p in positions):
+        return
+
+    for position in positions:
+        tracklist = position.tracklist
+        tracklist._tracks.remove(position)
+        tracklist._tracks.reorder()
+        track._tracklists.remove(position)
+        db.session.delete(position)
+    album.tracks.append(track)
+
+
+def known_locations(locations, session=None):
+    """Finds which locations are already stored using the location hash
+    index, a query per few hundred locations rather than one per file.
+
+    :returns {location: track_id}:
+    """
+    session = session or db.session
+    known = {}
+    for chunk in chunked(locations):
+        hashes = [location_hash(location) for location in chunk]
+        rows = session.query(Track.location, Track.id)\
+            .filter(Track.location_hash.in_(hashes))
+        known.update(rows)
+    return known
+
+
+def prune_tracks(tracks):
+    """Removes tracks whose files are gone, along with their places on any
+    tracklist. The remaining tracks on those tracklists are renumbered.
+    """
+    for track in tracks:
+        for position in list(track._tracklists):
+            tracklist = position.tracklist
+            tracklist._tracks.remove(position)
+            tracklist._tracks.reorder()
+            db.session.delete(position)
+        db.session.delete(track)
+    forget_streams([track.uuid for track in tracks])
+
+
+def store_group(group, incremental=False, bulk=False, stats=None):
+    """Stores a single parsed group, as produced by parse_group. Nothing is
+    committed, that's left to the caller.
+
+    :param group: Iterable of (filepath, info, error) triples
+    :param incremental: Re-read tracks that are already stored instead of
+    skipping them
+    :param bulk: Use set based inserts rather than the ORM
+    :param stats: IngestStats to record timings and counts with
+    :returns [info]: Information of newly stored tracks
+    """
+    stats = stats or IngestStats()
+    parsed = []
+    for filepath, info, error in group:
+        if error:
+            print('Error processing: {}'.format(filepath), error,
                   sep='\n', file=sys.stderr)
         else:
-            if all([art, alb, trk]):
-                end = int(time() - start)
-                print('\n**Storing: {0.name} - {1.name}'
-                      '\n  **Stored {2} files'
-                      '\n  **Took {3} seconds'
-                      '\n**Current Progress:'
-                      '\n  Total Tracks: {4}'
-                      '\n  Time: {5}\n'
-                      ''.format(art, alb, len(group), end,
-                                total_count, (time() - total_time)))
-    print('Finished!')
+            parsed.append(info)
+
+    with stats.timer('lookup'):
+        known = known_locations([info['location'] for info in parsed])
+
+    new = []
+    for info in parsed:
+        if info['location'] not in known:
+            new.append(info)
+        elif incremental:
+            with stats.timer('refresh'):
+                track = Track.query.get(known[info['location']])
+                art, trk, tags = refresh_track(track, info)
+            stats.count('updated')
+            print('* Updated: {0.name} - {1.name}'.format(art, trk))
+        else:
+            stats.count('skipped_known')
+            print('{} previously processed, skipping'.format(info['name']))
+
+    if bulk:
+        with stats.timer('store'):
+            rows = bulk_store(new)
+        for table, amount in rows.items():
+            stats.count('rows.' + table, amount)
+
+    for info in new:
+        if bulk:
+            tags = info['tags']
+        else:
+            with stats.timer('store'):
+                tags = [t.name for t in shove_into_models(info)[-1]]
+        print(
+            '* Processed: {0[artist]} - {0[album]} - {0[name]}'
+            '\n    With Tags: {1}'.format(info, ', '.join(tags)),
+            sep='\n', file=sys.stdout)
+
+    stats.count('inserted', len(new))
+    return new
+
+
+def _megabytes(size):
+    if size is None:
+        return 'unknown'
+    return '{:.1f}MB'.format(size / 1024.0 / 1024.0)
+
+
+def store_directory(basedir, valid_exts=valid_file_exts, adaptor=adaptor,
+                    jobs=None, incremental=False, bulk=False, cache=None,
+                    lean=False, journal=None, resume=False, walkers=None,
+                    stats=None, opener=open_file):
+    """Walks a directory, parses the tags of every audio file found and
+    stores the results, committing once per directory.
+
+    :param basedir: Directory to walk
+    :param valid_exts: Iterable of extensions to match against
+    :param adaptor: Callable that transforms a mutagen file into a dict
+    :param jobs: Number of worker processes to parse tags with, the
+    database is only ever written to from the calling process.
+    :param incremental: Skip files whose size, mtime and inode match what
+    was stored without opening them, and re-read the ones that changed.
+    :param bulk: Store batches of directories with set based inserts
+    rather than building ORM objects one track at a time. Each batch of
+    BULK_BATCH or so files is committed as a whole.
+    :param cache: Path to a TagCache, files whose size and mtime match
+    what's cached aren't opened.
+    :param lean: Release everything but recently used artists, albums and
+    tags from the session after each directory so memory use stays flat.
+    :param journal: Path to record committed directories at, the journal is
+    removed once the walk finishes.
+    :param resume: Skip directories recorded in an existing journal
+    :param walkers: List directories from this many threads with
+    scan_files rather than walking with filter_files
+    :param stats: IngestStats to record timings and counts with, a report
+    is printed once the walk finishes
+    :param opener: Callable that opens a file path for the adaptor
+    :returns IngestStats:
+    """
+    if opener is open_file and File is None:
+        # rather than recording every file as broken
+        raise RuntimeError('reading audio files needs mutagenx, or pass an '
+                           'opener')
+    stats = stats or IngestStats()
+    total_time = time()
+    total_count = 0
+    print('Begining walk of {}'.format(basedir))
+    if walkers:
+        groups = scan_files(basedir, valid_exts, threads=walkers)
+    else:
+        groups = filter_files(basedir, valid_exts)
+    groups = stats.time_iter('walk', groups, counter='files_seen')
+    checkpoints = Journal(journal, basedir, resume) if journal else None
+    if checkpoints is not None:
+        if len(checkpoints):
+            print('Resuming, {} directories done already'
+                  ''.format(len(checkpoints)))
+        groups = checkpoints.skip_completed(groups)
+    if incremental:
+        manifest = load_manifest()
+        print('Loaded {} known tracks'.format(len(manifest)))
+        groups = stats.time_iter('manifest', skip_unchanged(groups, manifest),
+                                 counter='files_changed')
+    start = time()
+    parsed_groups = parse_groups(groups, adaptor=adaptor, jobs=jobs,
+                                 cache=cache, opener=opener)
+    if bulk:
+        parsed_groups = batched_groups(parsed_groups, BULK_BATCH)
+    with stats.counting_rows(db.session()):
+        for group in stats.time_iter('parse', parsed_groups):
+            # with jobs the parse stage is time spent waiting on the workers,
+            # parse_cpu is the time they spent working
+            stats.add_time('parse_cpu', getattr(group, 'seconds', 0))
+            for name, amount in getattr(group, 'counts', {}).items():
+                stats.count(name, amount)
+
+            new = store_group(group, incremental=incremental, bulk=bulk,
+                              stats=stats)
+            last = new[-1] if new else None
+            try:
+                with stats.timer('commit'):
+                    db.session.commit()
+                total_count += len(group)
+                if checkpoints is not None:
+                    for part in getattr(group, 'groups', [group]):
+                        checkpoints.record([path for path, _, _ in part])
+            except IntegrityError as e:
+                db.session.rollback()
+                print('***Error encountered: {!s}'.format(e), sep='\n',
+                      file=sys.stderr)
+                if last:
+                    print('  Artist: {}'.format(last['artist']),
+                          '  Album: {}'.format(last['album']),
+                          '  Track: {}'.format(last['name']),
+                          sep='\n', file=sys.stderr)
+            else:
+                if last:
+                    end = int(time() - start)
+                    print('\n**Storing: {0[artist]} - {0[album]}'
+                          '\n  **Stored {1} files'
+                          '\n  **Took {2} seconds'
+                          '\n**Current Progress:'
+                          '\n  Total Tracks: {3}'
+                          '\n  Time: {4}'
+                          '\n  Peak Memory: {5}\n'
+                          ''.format(last, len(group), end,
+                                    total_count, (time() - total_time),
+                                    _megabytes(peak_rss())))
+            if lean:
+                release_session(db.session)
+            stats.emit('group', peak_rss=peak_rss())
+            start = time()
+    if checkpoints is not None:
+        checkpoints.finish()
+    stats.emit('summary', peak_rss=peak_rss())
+    print(stats.summary())
+    print('Finished! Peak Memory: {}'.format(_megabytes(peak_rss())))
+    return stats
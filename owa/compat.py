@@ -5,9 +5,10 @@ from functools import WRAPPER_ASSIGNMENTS, WRAPPER_UPDATES, partial
 PY3 = sys.version_info[0] > 2
 
 __all__ = ('update_wrapper', 'wraps', 'reduce', 'filter', 'filterfalse',
-           'map', 'range', 'zip')
+           'map', 'range', 'zip', 'scandir', 'string_types')
 
 if PY3:
+    string_types = (str,)
     map = map
     range = range
     zip = zip
@@ -15,11 +16,21 @@ if PY3:
     from functools import reduce
     from itertools import filterfalse
 else:
+    string_types = (basestring,)  # noqa: F821, Python 2 only
     range = xrange
     reduce = reduce
     from itertools import (imap as map, ifilter as filter,
                            izip as zip, ifilterfalse as filterfalse)
 
+# os.scandir is 3.5+, the scandir package backports it
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 # backport Python 3.4's update_wrapper to avoid silliness
 # has much smarter behavior than previous implementations of it
@@ -1,4 +1,5 @@
 from os import path, environ
+from tempfile import gettempdir
 
 
 basedir = path.abspath(path.dirname(__file__))
@@ -6,6 +7,10 @@ basedir = path.abspath(path.dirname(__file__))
 
 class BaseConfig(object):
     SQLALCHEMY_RECORD_QUERIES = False
+    TRANSCODER = 'owa.transcode.FFmpegTranscoder'
+    TRANSCODE_CACHE_DIR = environ.get(
+        'OWA_TRANSCODE_CACHE', path.join(gettempdir(), 'owa_transcodes'))
+    TRANSCODE_CACHE_SIZE = 1024 * 1024 * 1024
 
 
 class DevConfig(BaseConfig):
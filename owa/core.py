@@ -1,5 +1,6 @@
 import re
 from functools import partial
+from hashlib import sha1
 from itertools import chain
 
 _breaker_puncs = ('\\\\', '/', '&', ',', ' ', '\.', '_', '-')
@@ -79,3 +80,14 @@ def insert_tracks(tl, track_pos_pairs):
         else:
             tl.tracks.append(track)
     return track_pos_pairs
+
+
+def location_hash(location):
+    """Builds a short, fixed width key for a file path. Paths are long and
+    unbounded, which makes them a poor thing to index and compare against.
+
+    :param location: A file path as a byte or unicode string
+    """
+    if not isinstance(location, bytes):
+        location = location.encode('utf-8')
+    return sha1(location).hexdigest()
@@ -0,0 +1,178 @@
+"""
+    openwebamp.download
+    ~~~~~~~~~~~~~~~~~~~
+    Downloads of whole albums and playlists as a single zip.
+
+    The zip is written as it's sent. Entries are stored rather than
+    compressed (audio doesn't compress anyway) and each entry's checksum
+    follows its data, so every file is read exactly once, in blocks, and
+    nothing is held in memory or written to disk. Since stored entries
+    don't change size, the length of the whole zip is known up front.
+"""
+import os
+import struct
+import time
+from collections import namedtuple
+from zlib import crc32
+from flask import Blueprint, abort, current_app
+from werkzeug.utils import secure_filename
+from .models import db, Album, Playlist, Track, TrackPosition
+from .stream import read_range
+
+Download = Blueprint('download', __name__)
+
+ZIP64_LIMIT = 0xFFFFFFFF
+# data descriptor follows the file, name is utf-8
+FLAGS = 0x08 | 0x800
+# regular file, rw-r--r--
+EXTERNAL_ATTR = 0o100644 << 16
+
+ZipEntry = namedtuple('ZipEntry', ['name', 'location', 'size', 'mtime'])
+
+
+def dos_datetime(timestamp):
+    """Converts a timestamp into the (time, date) pair zip headers use.
+    """
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class ZipStream(object):
+    """Iterable zip of files, written as it's iterated over. Files larger
+    than 4GB can't be included, but the zip as a whole can be.
+
+    :param entries: Iterable of ZipEntry, the size is what will be sent
+    regardless of what the file holds by the time it's read
+    """
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+
+    def __len__(self):
+        offset = 0
+        central = 0
+        for entry in self.entries:
+            name = entry.name.encode('utf-8')
+            central += 46 + len(name) + (12 if offset >= ZIP64_LIMIT else 0)
+            offset += 30 + len(name) + entry.size + 16
+        return offset + central + self._end_size(offset, central)
+
+    def _end_size(self, offset, central):
+        if self._needs_zip64(offset, central):
+            return 56 + 20 + 22
+        return 22
+
+    def _needs_zip64(self, offset, central):
+        return (len(self.entries) >= 0xFFFF or offset >= ZIP64_LIMIT or
+                central >= ZIP64_LIMIT)
+
+    def __iter__(self):
+        offset = 0
+        directory = []
+
+        for entry in self.entries:
+            name = entry.name.encode('utf-8')
+            mtime, mdate = dos_datetime(entry.mtime)
+
+            yield struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, FLAGS, 0,
+                              mtime, mdate, 0, 0, 0, len(name), 0)
+            yield name
+
+            crc = 0
+            sent = 0
+            for chunk in read_range(open(entry.location, 'rb'), entry.size):
+                crc = crc32(chunk, crc)
+                sent += len(chunk)
+                yield chunk
+
+            if sent != entry.size:
+                raise IOError('{} shrank while it was being sent'.format(
+                    entry.location))
+
+            crc &= 0xFFFFFFFF
+            yield struct.pack('<IIII', 0x08074b50, crc, entry.size,
+                              entry.size)
+
+            directory.append((name, mtime, mdate, crc, entry.size, offset))
+            offset += 30 + len(name) + entry.size + 16
+
+        start = offset
+        for name, mtime, mdate, crc, size, at in directory:
+            extra = b''
+            version = 20
+            if at >= ZIP64_LIMIT:
+                extra = struct.pack('<HHQ', 0x0001, 8, at)
+                at = ZIP64_LIMIT
+                version = 45
+
+            record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, version,
+                                 version, FLAGS, 0, mtime, mdate, crc, size,
+                                 size, len(name), len(extra), 0, 0, 0,
+                                 EXTERNAL_ATTR, at)
+            offset += len(record) + len(name) + len(extra)
+            yield record + name + extra
+
+        central = offset - start
+        count = len(directory)
+
+        if self._needs_zip64(start, central):
+            yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                              count, count, central, start)
+            yield struct.pack('<IIQI', 0x07064b50, 0, offset, 1)
+
+        yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF),
+                          min(count, 0xFFFF), min(central, ZIP64_LIMIT),
+                          min(start, ZIP64_LIMIT), 0)
+
+
+def tracklist_entries(tracklist_id):
+    """Builds zip entries for every track on a tracklist whose file still
+    exists, numbered in tracklist order. Only the track locations are
+    loaded.
+    """
+    locations = db.session.query(Track.location)\
+        .join(TrackPosition, TrackPosition.track_id == Track.id)\
+        .filter(TrackPosition.tracklist_id == tracklist_id)\
+        .order_by(TrackPosition.position)
+
+    entries = []
+    for number, (location,) in enumerate(locations, 1):
+        try:
+            stat = os.stat(location)
+        except OSError:
+            continue
+        name = u'{:02d} - {}'.format(number, os.path.basename(location))
+        entries.append(ZipEntry(name, location, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def send_zip(name, entries):
+    """Sends entries as a zip download named after name.
+    """
+    filename = (secure_filename(name) or 'download') + '.zip'
+    body = ZipStream(entries)
+    headers = {'Content-Length': str(len(body)),
+               'Content-Disposition': 'attachment; filename="{}"'.format(
+                   filename)}
+    return current_app.response_class(iter(body), headers=headers,
+                                      mimetype='application/zip',
+                                      direct_passthrough=True)
+
+
+def download_tracklist(model, id):
+    name = db.session.query(model.name).filter(model.id == id).scalar()
+    if name is None:
+        abort(404)
+    return send_zip(name, tracklist_entries(id))
+
+
+@Download.route('/album/<int:id>/download')
+def album(id):
+    return download_tracklist(Album, id)
+
+
+@Download.route('/playlist/<int:id>/download')
+def playlist(id):
+    return download_tracklist(Playlist, id)
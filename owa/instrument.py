@@ -0,0 +1,146 @@
+"""
+    openwebamp.instrument
+    ~~~~~~~~~~~~~~~~~~~~~
+    Timers and counters for finding out where an import spends its time.
+"""
+from __future__ import print_function
+import json
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from time import time
+from sqlalchemy import event
+from sqlalchemy.orm import object_mapper
+
+
+class IngestStats(object):
+    """Collects per stage timings and counters over the course of an import.
+
+    Stage timers are exclusive: time spent in a stage that's started while
+    another is running is only counted against the inner stage. This matters
+    because walking, filtering and parsing are chained generators. Each
+    thread keeps its own stack of running stages.
+
+    :param output: Optional file like object that gets a JSON line every
+    time emit is called
+    """
+
+    def __init__(self, output=None):
+        self.output = output
+        self.started = time()
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+        self._local = threading.local()
+        # kept around so the same callable can be removed as a listener
+        self._flush_listener = self._count_flushed
+        self._query_listener = self._count_query
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def timer(self, stage):
+        stack = self._stack()
+        now = time()
+        if stack:
+            parent, since = stack[-1]
+            self.timers[parent] += now - since
+        stack.append([stage, now])
+        try:
+            yield
+        finally:
+            now = time()
+            _, since = stack.pop()
+            self.timers[stage] += now - since
+            if stack:
+                stack[-1][1] = now
+
+    def time_iter(self, stage, iterable, counter=None):
+        """Times how long it takes to pull each item out of an iterable,
+        optionally adding the length of each item to a counter.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            if counter:
+                self.count(counter, len(item))
+            yield item
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def _count_flushed(self, session, context):
+        for obj in session.new:
+            # joined inheritance, like Album, writes a row to each table
+            for table in object_mapper(obj).tables:
+                self.count('rows.' + table.name)
+
+    @contextmanager
+    def counting_rows(self, session):
+        """Counts rows the ORM inserts through a session, by table, while
+        the block runs.
+        """
+        event.listen(session, 'after_flush', self._flush_listener)
+        try:
+            yield
+        finally:
+            event.remove(session, 'after_flush', self._flush_listener)
+
+    def _count_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        self.count('queries')
+
+    @contextmanager
+    def counting_queries(self, engine):
+        """Counts statements sent to the database while the block runs, an
+        executemany counts once.
+        """
+        event.listen(engine, 'before_cursor_execute', self._query_listener)
+        try:
+            yield
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         self._query_listener)
+
+    def add_time(self, stage, seconds):
+        """Adds time measured somewhere else, like in a worker process.
+        """
+        self.timers[stage] += seconds
+
+    def report(self):
+        elapsed = time() - self.started
+        seen = self.counters.get('files_seen', 0)
+        return {
+            'elapsed': round(elapsed, 3),
+            'files_per_second': round(seen / elapsed, 2) if elapsed else 0,
+            'stages': {k: round(v, 3) for k, v in self.timers.items()},
+            'counts': dict(self.counters)
+        }
+
+    def emit(self, event, **extra):
+        """Writes the current report as a single line of JSON.
+        """
+        if self.output is None:
+            return
+        line = dict(self.report(), event=event, **extra)
+        self.output.write(json.dumps(line, sort_keys=True) + '\n')
+        self.output.flush()
+
+    def summary(self):
+        report = self.report()
+        lines = ['**Stages:']
+        lines.extend('  {:<10} {:>10.3f}s'.format(stage, seconds)
+                     for stage, seconds in sorted(report['stages'].items()))
+        lines.append('**Counts:')
+        lines.extend('  {:<24} {:>10}'.format(name, amount)
+                     for name, amount in sorted(report['counts'].items()))
+        lines.append('**Throughput: {} files/second over {} seconds'
+                     ''.format(report['files_per_second'], report['elapsed']))
+        return '\n'.join(lines)
@@ -0,0 +1,71 @@
+"""
+    openwebamp.journal
+    ~~~~~~~~~~~~~~~~~~
+    Checkpoint journal for resuming an interrupted import.
+"""
+import io
+import os
+
+
+class Journal(object):
+    """Records every directory store_directory has committed, one path per
+    line, synced to disk as it's written. The first line is the directory
+    being imported, a journal left over from importing somewhere else is
+    never resumed from.
+
+    :param path: Where to keep the journal
+    :param basedir: Directory being imported
+    :param resume: Pick up from an existing journal rather than starting a
+    new one
+    """
+
+    def __init__(self, path, basedir, resume=False):
+        self.path = path
+        self.basedir = os.path.abspath(basedir)
+        self.completed = set()
+
+        if resume and os.path.exists(path):
+            with io.open(path, encoding='utf-8') as fh:
+                lines = fh.read().splitlines()
+            if lines and lines[0] == self.basedir:
+                self.completed.update(lines[1:])
+
+        resumed = bool(self.completed)
+        self._fh = io.open(path, 'a' if resumed else 'w', encoding='utf-8')
+        if not resumed:
+            self._write(self.basedir)
+
+    def __contains__(self, directory):
+        return directory in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def _write(self, line):
+        self._fh.write(u'{}\n'.format(line))
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def record(self, group):
+        """Marks the directory a group of files came from as committed.
+        """
+        if group:
+            directory = os.path.dirname(group[0])
+            self.completed.add(directory)
+            self._write(directory)
+
+    def skip_completed(self, groups):
+        """Drops groups from directories that were already committed.
+        """
+        for group in groups:
+            if not group or os.path.dirname(group[0]) not in self:
+                yield group
+
+    def close(self):
+        self._fh.close()
+
+    def finish(self):
+        """The import went all the way through, nothing's left to resume.
+        """
+        self.close()
+        os.remove(self.path)
@@ -12,15 +12,19 @@
     Helper Models:
     - ArtistTag
     - TrackPosition
+    - Revision
 """
-from flask.ext.sqlalchemy import SQLAlchemy
+from datetime import datetime
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
 from uuid import uuid4
+from sqlalchemy import event
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.orderinglist import ordering_list
-from .utils import ReprMixin, UniqueMixin
-from .core import break_tag
+from sqlalchemy.orm import validates
+from .utils import ReprMixin, UniqueMixin, chunked
+from .core import break_tag, location_hash
 
 
 db = SQLAlchemy()
@@ -95,16 +99,40 @@ class Track(BaseModel, db.Model):
     artist = db.relationship('Artist')
     length = db.Column(db.Integer)
     location = db.Column(db.UnicodeText, unique=True)
+    location_hash = db.Column(db.String(40), index=True)
     name = db.Column(db.UnicodeText)
     _tracklists = db.relationship('TrackPosition', backref='track')
     tracklists = association_proxy('_tracklists', 'tracklist')
     uuid = db.Column(db.String(36), unique=True, default=lambda: str(uuid4()))
 
-    def __init__(self, name, artist, length, location):
+    # file stats as of the last time the file was read, used to skip
+    # unchanged files when rescanning the library
+    size = db.Column(db.BigInteger)
+    mtime = db.Column(db.Integer)
+    inode = db.Column(db.BigInteger)
+    # recognizes the file if it's moved, see owa.cli.fingerprint
+    fingerprint = db.Column(db.String(40))
+
+    def __init__(self, name, artist, length, location,
+                 size=None, mtime=None, inode=None, fingerprint=None):
         self.name = name
         self.artist = artist
         self.length = length
         self.location = location
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+        self.fingerprint = fingerprint
+
+    @validates('location')
+    def _hash_location(self, key, location):
+        self.location_hash = location_hash(location)
+        return location
+
+    @classmethod
+    def by_location(cls, location):
+        return cls.query.filter(cls.location_hash == location_hash(location),
+                                cls.location == location).first()
 
 
 class Tracklist(BaseModel, db.Model):
@@ -117,19 +145,53 @@ class Tracklist(BaseModel, db.Model):
     tracks = association_proxy('_tracks', 'track',
                                creator=lambda track: TrackPosition(track=track))
 
+    # kept up to date as tracks are added and removed, see the listeners
+    # below and refresh_counters
+    track_count = db.Column(db.Integer, default=0, index=True)
+    duration = db.Column(db.Integer, default=0, index=True)
+
     def __init__(self, name, tracks=None):
         self.name = name
+        self.track_count = 0
+        self.duration = 0
 
         if tracks:
             self.tracks.extend(tracks)
 
     @hybrid_property
     def length(self):
-        return sum(t.length for t in self.tracks)
+        return self.duration or 0
+
+    @length.expression
+    def length(cls):
+        return cls.duration
 
     @hybrid_property
     def total_tracks(self):
-        return len(self.tracks)
+        return self.track_count or 0
+
+    @total_tracks.expression
+    def total_tracks(cls):
+        return cls.track_count
+
+    @classmethod
+    def summed_length(cls):
+        """Sums the lengths of the tracklist's tracks in SQL, rather than
+        reading the counter.
+        """
+        return db.select([db.func.coalesce(db.func.sum(Track.length), 0)])\
+            .where(TrackPosition.tracklist_id == cls.id)\
+            .where(TrackPosition.track_id == Track.id)\
+            .as_scalar()
+
+    @classmethod
+    def counted_tracks(cls):
+        """Counts the tracklist's tracks in SQL, rather than reading the
+        counter.
+        """
+        return db.select([db.func.count(TrackPosition.id)])\
+            .where(TrackPosition.tracklist_id == cls.id)\
+            .as_scalar()
 
     __mapper_args__ = {
         'polymorphic_on': type,
@@ -160,7 +222,8 @@ class Album(Tracklist, UniqueMixin):
         return query.filter(cls.name == name, cls.artist_id == artist.id)
 
     __table_args__ = (
-        db.Constraint('name', 'artist_id'),
+        db.UniqueConstraint('name', 'artist_id',
+                            name='uq_album_name_artist_id'),
     )
 
     __mapper_args__ = {
@@ -198,8 +261,7 @@ class ArtistTag(BaseModel, db.Model):
     artist_id = db.Column(db.Integer, db.ForeignKey('artists.id'))
     artist = db.relationship('Artist', backref='_tags')
     tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'))
-    tag = db.relationship('Tag',
-                          backref=db.backref('_artists', lazy='dynamic'))
+    tag = db.relationship('Tag', backref='_artists')
 
     __table_args__ = (
         db.UniqueConstraint('artist_id', 'tag_id'),
@@ -219,3 +281,111 @@ class TrackPosition(BaseModel, db.Model):
         # ensure a track can't appear in an invalid position on a given list
         db.CheckConstraint('position > -1')
     )
+
+
+def refresh_counters(session, tracklist_ids=None):
+    """Recounts track_count and duration from the tracklists' positions. The
+    ORM keeps the counters right on its own, this is for writes that bypass
+    it.
+
+    :param session: Session to write with
+    :param tracklist_ids: Tracklists to recount, defaults to all of them
+    """
+    table = Tracklist.__table__
+    update = table.update().values(track_count=Tracklist.counted_tracks(),
+                                   duration=Tracklist.summed_length())
+    if tracklist_ids is None:
+        session.execute(update)
+        return
+
+    for chunk in chunked(tracklist_ids):
+        session.execute(update.where(table.c.id.in_(chunk)))
+
+
+def _track_length(position):
+    return (position.track.length or 0) if position.track else 0
+
+
+@event.listens_for(Tracklist._tracks, 'append', propagate=True)
+def _count_added(tracklist, position, initiator):
+    tracklist.track_count = (tracklist.track_count or 0) + 1
+    tracklist.duration = (tracklist.duration or 0) + _track_length(position)
+
+
+@event.listens_for(Tracklist._tracks, 'remove', propagate=True)
+def _count_removed(tracklist, position, initiator):
+    tracklist.track_count = (tracklist.track_count or 0) - 1
+    tracklist.duration = (tracklist.duration or 0) - _track_length(position)
+
+
+@event.listens_for(Track.length, 'set', active_history=True)
+def _length_changed(track, length, old, initiator):
+    change = (length or 0) - (old if isinstance(old, int) else 0)
+    if not change or track.id is None:
+        return
+    for position in track._tracklists:
+        if position.tracklist is not None:
+            position.tracklist.duration = \
+                (position.tracklist.duration or 0) + change
+
+
+class Revision(BaseModel, db.Model):
+    """A single row that changes whenever anything else in the database
+    does. Checking it is a cheap way to tell if what a client has cached
+    could be stale.
+    """
+    repr_fields = ('number', 'changed')
+
+    number = db.Column(db.Integer, default=0)
+    changed = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @classmethod
+    def current(cls, session=None):
+        """Returns the current (number, changed) pair, or None if nothing has
+        been recorded yet.
+        """
+        session = session or db.session
+        return session.query(cls.number, cls.changed)\
+            .filter(cls.id == 1).first()
+
+
+def bump_revision(session):
+    """Records that something changed. Changes made through the ORM are
+    picked up automatically, this only needs calling after bulk or core
+    level writes.
+
+    The revision itself is only written once, when the session commits, so
+    flushes in between don't each update (and lock) its row.
+    """
+    session.info['revision_changed'] = True
+
+
+def _write_revision(session):
+    table = Revision.__table__
+    now = datetime.utcnow()
+    result = session.execute(table.update()
+                             .where(table.c.id == 1)
+                             .values(number=table.c.number + 1, changed=now))
+    if not result.rowcount:
+        session.execute(table.insert().values(id=1, number=1, changed=now))
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _changed_after_flush(session, context):
+    if session.new or session.dirty or session.deleted:
+        bump_revision(session)
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def _bump_before_commit(session):
+    # whatever is still pending is flushed after this runs
+    changed = session.info.pop('revision_changed', False)
+    if changed or session.new or session.dirty or session.deleted:
+        _write_revision(session)
+
+
+# the commit's own flush marks what before_commit already counted
+@event.listens_for(SignallingSession, 'after_commit')
+@event.listens_for(SignallingSession, 'after_rollback')
+def _forget_revision_change(session):
+    session.info.pop('revision_changed', None)
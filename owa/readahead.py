@@ -0,0 +1,74 @@
+"""
+    openwebamp.readahead
+    ~~~~~~~~~~~~~~~~~~~~
+    Warms the page cache with the start of the tracks that come next on a
+    tracklist, so a player moving on to the next track doesn't stall while
+    a cold file is fetched from a slow disk or a network mount.
+
+    Where posix_fadvise is available the kernel is asked to read ahead,
+    otherwise the first blocks of each file are read and thrown away. Either
+    way it's done on a background thread.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import time
+from .models import db, Track, TrackPosition
+from .utils import LRUCache
+
+BLOCK_SIZE = 64 * 1024
+READ_AHEAD_TRACKS = 2
+READ_AHEAD_BYTES = 2 * 1024 * 1024
+# players ask for a track in many ranges, only hint once in a while
+HINT_INTERVAL = 60
+
+_executor = ThreadPoolExecutor(1)
+_hinted = LRUCache(256)
+_hinted_lock = Lock()
+
+
+def warm(location, length=READ_AHEAD_BYTES):
+    """Gets the first length bytes of a file into the page cache.
+    """
+    try:
+        with open(location, 'rb') as fh:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fh.fileno(), 0, length,
+                                 os.POSIX_FADV_WILLNEED)
+            else:
+                while length > 0:
+                    chunk = fh.read(min(length, BLOCK_SIZE))
+                    if not chunk:
+                        break
+                    length -= len(chunk)
+    except (IOError, OSError):
+        pass
+
+
+def upcoming(tracklist_id, position, count=READ_AHEAD_TRACKS):
+    """Locations of the count tracks that follow position on a tracklist.
+    """
+    return [location for location, in db.session.query(Track.location)
+            .join(TrackPosition, TrackPosition.track_id == Track.id)
+            .filter(TrackPosition.tracklist_id == tracklist_id,
+                    TrackPosition.position > position)
+            .order_by(TrackPosition.position)
+            .limit(count)]
+
+
+def read_ahead(tracklist_id, position):
+    """Starts warming the tracks after position on a tracklist, unless
+    that was done recently.
+
+    :param tracklist_id: Id of the album or playlist being played
+    :param position: Position on it of the track being streamed
+    """
+    key = (tracklist_id, position)
+    now = time()
+    with _hinted_lock:
+        if now - _hinted.get(key, 0) < HINT_INTERVAL:
+            return
+        _hinted[key] = now
+
+    for location in upcoming(tracklist_id, position):
+        _executor.submit(warm, location)
@@ -0,0 +1,179 @@
+"""
+    openwebamp.reconcile
+    ~~~~~~~~~~~~~~~~~~~~
+    Brings stored tracks back in line with files that were moved or deleted.
+
+    A moved file is recognized by its size and fingerprint and its track has
+    its location rewritten in place, so the track keeps its id, uuid and its
+    places on every tracklist. Tracks stored before fingerprints were have
+    neither, those are recognized by their name, artist and length instead.
+    Tracks whose files are really gone are reported and, if asked, pruned.
+"""
+from __future__ import print_function
+import os
+from collections import namedtuple
+from .cli import (valid_file_exts, adaptor, file_stats, filter_files,
+                  fingerprint, load_manifest, open_file, prune_tracks)
+from .core import location_hash
+from .models import db, bump_revision, Artist, Track
+from .stream import forget_streams
+from .utils import chunked, under
+
+
+Missing = namedtuple('Missing', ['id', 'uuid', 'location', 'size',
+                                 'fingerprint', 'name', 'artist', 'length'])
+
+
+def find_missing(prefixes=None, session=None):
+    """Finds stored tracks whose files no longer exist. Only the columns
+    needed to match them up again are loaded.
+
+    :param prefixes: Only look at tracks under these directories
+    :param session: Session to query with, defaults to db.session
+    :returns [Missing]:
+    """
+    session = session or db.session
+    query = session.query(Track.id, Track.uuid, Track.location, Track.size,
+                          Track.fingerprint, Track.name, Artist.name,
+                          Track.length)\
+        .outerjoin(Artist, Track.artist_id == Artist.id)
+
+    if prefixes:
+        query = query.filter(db.or_(*[under(Track.location, p)
+                                      for p in prefixes]))
+
+    return [Missing(*row) for row in query
+            if not os.path.exists(row.location)]
+
+
+def _read_tags(path, adaptor, opener):
+    """The name, artist and length a file is tagged with, or None if it
+    can't be read.
+    """
+    try:
+        info = adaptor(opener(path))
+    except Exception:
+        return None
+    return info['name'], info['artist'], info['length']
+
+
+def relocate(missing, candidates, session=None, adaptor=adaptor,
+             opener=open_file):
+    """Matches missing tracks against files that aren't stored yet and
+    points each matched track at its new location. Candidates are only
+    fingerprinted if their size matches a missing track.
+
+    Tracks without a fingerprint, stored before there were any, are matched
+    by the name, artist and length their file was tagged with instead. Their
+    size and fingerprint are filled in once they're found. Candidates are
+    only opened while such tracks are left to match.
+
+    :param missing: Iterable of Missing tracks
+    :param candidates: Iterable of file paths that aren't stored
+    :param session: Session to write with, defaults to db.session
+    :param adaptor: Callable that transforms a mutagen file into a dict
+    :param opener: Callable that opens a file path for the adaptor
+    :returns ([(Missing, new location)], [Missing]): Moved and unmatched
+    tracks
+    """
+    session = session or db.session
+    missing = list(missing)
+    by_size = {}
+    by_tags = {}
+    for track in missing:
+        if track.fingerprint:
+            by_size.setdefault(track.size, []).append(track)
+        else:
+            key = (track.name, track.artist, track.length)
+            by_tags.setdefault(key, []).append(track)
+
+    untagged = len(missing) - sum(len(v) for v in by_size.values())
+    moved = []
+    for path in candidates:
+        try:
+            stats = file_stats(path)
+            waiting = by_size.get(stats['size'])
+            found = fingerprint(path) if waiting or untagged else None
+        except OSError:
+            # gone again since the walk found it
+            continue
+
+        matched = [t for t in waiting or () if t.fingerprint == found][:1]
+        if not matched and untagged:
+            waiting = by_tags.get(_read_tags(path, adaptor, opener))
+            matched = waiting[:1] if waiting else []
+            untagged -= len(matched)
+
+        for track in matched:
+            waiting.remove(track)
+            moved.append((track, path, dict(stats, fingerprint=found)))
+
+    if moved:
+        session.bulk_update_mappings(Track, [
+            dict(id=track.id, location=path, location_hash=location_hash(path),
+                 mtime=stats['mtime'], inode=stats['inode'],
+                 size=stats['size'], fingerprint=stats['fingerprint'])
+            for track, path, stats in moved])
+        bump_revision(session)
+        forget_streams([track.uuid for track, _, _ in moved])
+
+    matched = {track.id for track, _, _ in moved}
+    unmatched = [track for track in missing if track.id not in matched]
+    return [(track, path) for track, path, _ in moved], unmatched
+
+
+def unstored_files(roots, valid_exts=valid_file_exts, manifest=None):
+    """Yields files under the roots that aren't stored.
+
+    :param manifest: Manifest of stored tracks, see owa.cli.load_manifest
+    """
+    if manifest is None:
+        manifest = load_manifest()
+
+    for root in roots:
+        for group in filter_files(root, valid_exts):
+            for path in group:
+                if location_hash(path) not in manifest:
+                    yield path
+
+
+def reconcile(roots, valid_exts=valid_file_exts, prune=False):
+    """Finds tracks whose files have gone missing, relocates the ones that
+    were moved somewhere under the roots and optionally prunes the rest.
+
+    Only tracks under the roots are looked at, tracks under any other
+    directory, like a share that isn't mounted right now, are left alone.
+
+    :param roots: Iterable of library directories
+    :param valid_exts: Iterable of extensions to match against
+    :param prune: Remove tracks that can't be found rather than only
+    reporting them
+    :returns ([(Missing, new location)], [Missing]): Moved and unmatched
+    tracks
+    :raises ValueError: If no roots are given
+    """
+    if not roots:
+        raise ValueError('At least one library directory is needed')
+
+    roots = [os.path.abspath(r) for r in roots]
+    missing = find_missing(prefixes=roots)
+    print('Found {} missing tracks'.format(len(missing)))
+
+    if not missing:
+        return [], []
+
+    moved, gone = relocate(missing, unstored_files(roots, valid_exts))
+
+    for track, location in moved:
+        print('* Moved: {} -> {}'.format(track.location, location))
+
+    for track in gone:
+        print('* Missing: {}'.format(track.location))
+
+    if prune and gone:
+        for chunk in chunked([t.id for t in gone]):
+            prune_tracks(Track.query.filter(Track.id.in_(chunk)).all())
+        print('Pruned {} tracks'.format(len(gone)))
+
+    db.session.commit()
+    return moved, gone
@@ -1,14 +1,232 @@
+from flask import current_app, request
+from flask.ext.marshmallow.fields import Hyperlinks, URLFor, _tpl
 from flask.ext.restful import Resource
+from flask.ext.restful.utils import unpack
 from inspect import isclass
-from .compat import filter
+from numbers import Integral
+from marshmallow.fields import List, Nested
+from sqlalchemy import and_, or_, inspect
+from sqlalchemy.orm import joinedload, load_only, subqueryload
+from werkzeug.http import http_date, is_resource_modified
+from .compat import filter, string_types, wraps
+from .models import Revision
 from .schemas import BaseSchema
-from .utils import get_page_and_limit
+from .serialize import dump
+from .utils import (decode_cursor, encode_cursor, get_fields,
+                    get_page_and_limit)
+
+
+def conditional(method):
+    """Adds a weak ETag and Last-Modified taken from the database's
+    Revision to what a resource method returns, and answers requests that
+    already have the current revision with a 304 before the method runs,
+    which skips the query and serialization.
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        revision = Revision.current()
+
+        if revision is None:
+            return method(*args, **kwargs)
+
+        number, changed = revision
+        headers = {'ETag': 'W/"{}"'.format(number),
+                   'Last-Modified': http_date(changed)}
+
+        if not is_resource_modified(request.environ, etag=headers['ETag'],
+                                    last_modified=changed):
+            return current_app.response_class(status=304, headers=headers)
+
+        data, code, extra = unpack(method(*args, **kwargs))
+        headers.update(extra)
+        return data, code, headers
+    return wrapper
+
+
+def eager_paths(schema, model, depth=3):
+    """Finds the relationships a schema walks when dumping a model, from its
+    nested fields (minding only) and any association proxies they go
+    through.
+
+    :param schema: Schema instance that will do the dumping
+    :param model: Model class being dumped
+    :param depth: How deep to follow nested schemas
+    :returns [[relationship]]: Paths from the model, one per relationship
+    reached
+    """
+    paths = []
+    for name, field in schema.fields.items():
+        if isinstance(field, List):
+            field = field.container
+
+        attr = field.attribute or name
+        proxy = getattr(model, attr, None)
+        if hasattr(proxy, 'target_collection'):
+            keys = [proxy.target_collection, proxy.value_attr]
+        else:
+            keys = [attr]
+
+        path, target = [], model
+        for key in keys:
+            rel = inspect(target).relationships.get(key)
+            # dynamic relationships are queries and can't be loaded ahead
+            if rel is None or rel.lazy == 'dynamic':
+                break
+            path.append(rel)
+            target = rel.mapper.class_
+        else:
+            paths.append(path)
+            if isinstance(field, Nested) and depth > 1:
+                paths.extend(path + sub for sub in
+                             eager_paths(field.schema, target, depth - 1))
+    return paths
+
+
+def eager_loaders(schema, model):
+    """Loader options that fetch everything a schema walks up front, so
+    dumping runs a fixed number of queries however many items there are.
+    Collections are loaded with a query each, everything else is joined.
+    """
+    options = []
+    for path in eager_paths(schema, model):
+        option = None
+        for rel in path:
+            attr = getattr(rel.parent.class_, rel.key)
+            loader = subqueryload if rel.uselist else joinedload
+            option = (loader(attr) if option is None else
+                      getattr(option, loader.__name__)(attr))
+        options.append(option)
+    return options
+
+
+def link_attributes(links):
+    """Names of the attributes the URLs in a Hyperlinks' dict are built
+    from.
+    """
+    if isinstance(links, dict):
+        return [attr for value in links.values()
+                for attr in link_attributes(value)]
+    if isinstance(links, URLFor):
+        return [attr for attr in (_tpl(str(value))
+                                  for value in links.params.values()) if attr]
+    return []
+
+
+def schema_columns(schema, model):
+    """Finds the columns a schema reads off a model, for its own fields, for
+    the links it builds and to follow the relationships it walks.
+
+    :returns set or None: Names of the column attributes, or None when the
+    schema reads something, like a hybrid, whose columns can't be told
+    """
+    mapper = inspect(model)
+    keys = set()
+    for name, field in schema.fields.items():
+        if isinstance(field, Hyperlinks):
+            attrs = link_attributes(field.schema)
+        else:
+            attrs = [field.attribute or name]
+
+        for attr in attrs:
+            proxy = getattr(model, attr, None)
+            if hasattr(proxy, 'target_collection'):
+                attr = proxy.target_collection
+            if attr in mapper.column_attrs:
+                keys.add(attr)
+            elif attr in mapper.relationships:
+                keys.update(mapper.get_property_by_column(column).key
+                            for column in
+                            mapper.relationships[attr].local_columns)
+            else:
+                return None
+    return keys
+
+
+def column_fields(schema, model):
+    """Finds the fields a schema's class declares that show a plain column
+    of the model. A ?fields= selection may pick these even when the
+    resource's only leaves them out, they're loaded with the row anyway and
+    don't widen what's joined.
+
+    :returns set: Field names, less any the schema excludes
+    """
+    mapper = inspect(model)
+    names = set()
+    for name, field in schema.__class__().fields.items():
+        if isinstance(field, (Hyperlinks, List, Nested)):
+            continue
+        if (field.attribute or name) in mapper.column_attrs:
+            names.add(name)
+    return names - set(schema.exclude or ())
+
+
+def cursor_value_fits(key, value):
+    """Checks a value taken from a cursor is of the type a key's column
+    holds, so it can't be compared against something it doesn't fit.
+    """
+    try:
+        expected = key.type.python_type
+    except NotImplementedError:
+        return value is not None
+    if issubclass(expected, string_types):
+        return isinstance(value, string_types)
+    if issubclass(expected, Integral):
+        return isinstance(value, Integral) and not isinstance(value, bool)
+    return isinstance(value, expected)
 
 
 class OWAResource(Resource):
     routes = []
     route_opts = {}
 
+    @classmethod
+    def loaders(cls):
+        """Loader options for the resource's schema, worked out once.
+        """
+        if '_loaders' not in cls.__dict__:
+            cls._loaders = eager_loaders(cls.schema, cls.model)
+        return cls._loaders
+
+    @classmethod
+    def narrowed(cls, fields, keep=()):
+        """The schema and loader options to use for a ?fields= selection.
+        Only the relationships the narrowed schema walks are loaded and,
+        where it can be told, only the columns it reads. Worked out once for
+        each selection.
+
+        Fields can be picked from those the resource's schema shows, as set
+        by its only and exclude, and from the schema class's plain column
+        fields, see column_fields.
+
+        :param fields: Sorted tuple of field names or None for all of them
+        :param keep: Column attributes to load regardless, like sort keys
+        :returns (schema, [option]):
+        :raises ValueError: If a field isn't one the schema has
+        """
+        if fields is None:
+            return cls.schema, cls.loaders()
+
+        if '_narrowed' not in cls.__dict__:
+            cls._narrowed = {}
+        key = (fields, keep)
+        if key not in cls._narrowed:
+            known = set(cls.schema.fields) | column_fields(cls.schema,
+                                                           cls.model)
+            unknown = set(fields) - known
+            if unknown:
+                raise ValueError('unknown fields: {}'.format(
+                    ', '.join(sorted(unknown))))
+
+            schema = cls.schema.__class__(many=cls.schema.many, only=fields,
+                                          exclude=cls.schema.exclude)
+            options = eager_loaders(schema, cls.model)
+            columns = schema_columns(schema, cls.model)
+            if columns is not None:
+                options.append(load_only(*[getattr(cls.model, column)
+                                           for column in columns | set(keep)]))
+            cls._narrowed[key] = schema, options
+        return cls._narrowed[key]
+
     @classmethod
     def register(cls, api):
         """Helper method to make registering resources on multiple endpoints
@@ -18,30 +236,141 @@ class OWAResource(Resource):
 
 
 class SingleResource(OWAResource):
+    """Shows one item. ?fields= narrows it down to some of the schema's
+    fields, and only what those need is loaded.
+    """
     schema = BaseSchema()
     model = None
 
+    @conditional
     def get(self, **filters):
         if self.model:
-            item = self.model.query.filter_by(**filters).first()
+            try:
+                schema, options = self.narrowed(get_fields())
+            except ValueError as e:
+                return {'error': str(e)}, 400
+
+            item = self.model.query.options(*options)\
+                .filter_by(**filters).first()
             if item:
-                return self.schema.dump(item).data
+                return dump(schema, item)
             return {'error': 'no results found'}
         return {'error': 'no model found'}
 
 
 class ListResource(OWAResource):
+    """Lists a model a page at a time, ordered by order_by with ties broken
+    by id.
+
+    Pages are found by key rather than by offset: each page carries a
+    ``next`` cursor made from its last item and passing that back as
+    ?cursor= filters on the key, so a deep page costs the same as the first.
+    ?page= still works but is an offset underneath. Nothing is counted
+    unless ?count=1 is passed. ?fields= narrows down the fields shown for each
+    item like it does for SingleResource.
+
+    ?ids=1,5,9 fetches those items instead of a page, see batch.
+    """
     schema = BaseSchema(many=True)
     model = None
+    order_by = 'id'
+    max_ids = 100
 
+    @conditional
     def get(self):
-        if self.model:
-            page, limit = get_page_and_limit()
-            items = self.model.query.paginate(page, limit, error_out=False).items
-            return self.schema.dump(items).data
-        else:
+        if not self.model:
             return {'error': 'no model found'}
 
+        page, limit = get_page_and_limit()
+        limit = max(limit, 1)
+        key, id = getattr(self.model, self.order_by), self.model.id
+        keys = (id,) if self.order_by == 'id' else (key, id)
+
+        try:
+            schema, options = self.narrowed(get_fields(),
+                                            keep=(self.order_by,))
+        except ValueError as e:
+            return {'error': str(e)}, 400
+
+        if 'ids' in request.args:
+            return self.batch(request.args['ids'], schema, options)
+
+        query = self.model.query.options(*options)
+
+        total = None
+        if request.args.get('count', type=int):
+            total = query.count()
+
+        query = query.order_by(*keys)
+        if 'cursor' in request.args:
+            try:
+                after = decode_cursor(request.args['cursor'])
+                query = query.filter(self.after(keys, after))
+            except ValueError:
+                return {'error': 'invalid cursor'}, 400
+        elif page > 1:
+            query = query.offset((page - 1) * limit)
+
+        # one more than asked for tells if there's a next page
+        items = query.limit(limit + 1).all()
+        data = dump(schema, items[:limit])
+
+        data['next'] = None
+        if len(items) > limit:
+            last = items[limit - 1]
+            data['next'] = encode_cursor(*[getattr(last, k.key)
+                                           for k in keys])
+        if total is not None:
+            data['total'] = total
+        return data
+
+    def batch(self, ids, schema, options):
+        """Fetches items by id with a single query, in place of asking for
+        each one on its own.
+
+        Items come back in the order they were asked for, with a null in
+        place of each one that doesn't exist and those ids listed under
+        ``missing``.
+
+        :param ids: Comma separated ids, at most max_ids of them
+        """
+        try:
+            ids = [int(id) for id in ids.split(',') if id.strip()]
+        except ValueError:
+            return {'error': 'invalid ids'}, 400
+        if len(ids) > self.max_ids:
+            return {'error': 'at most {} ids'.format(self.max_ids)}, 400
+
+        found = {}
+        if ids:
+            query = self.model.query.options(*options)\
+                .filter(self.model.id.in_(set(ids)))
+            found = dict((item.id, item) for item in query)
+
+        data = dump(schema, [found[id] for id in ids if id in found])
+        # the schema puts the items under a single key named after it
+        ns, items = data.popitem()
+        items = iter(items)
+        data[ns] = [next(items) if id in found else None for id in ids]
+        data['missing'] = [id for id in ids if id not in found]
+        return data
+
+    @staticmethod
+    def after(keys, values):
+        """Filters for rows that sort after values by keys.
+
+        :raises ValueError: If values don't match the keys in number or type
+        """
+        if len(keys) != len(values):
+            raise ValueError('cursor does not match keys')
+        for key, value in zip(keys, values):
+            if not cursor_value_fits(key, value):
+                raise ValueError('cursor does not match keys')
+        if len(keys) == 1:
+            return keys[0] > values[0]
+        key, id = keys
+        return or_(key > values[0], and_(key == values[0], id > values[1]))
+
 
 def register_all_resources(module, api):
     classes = filter(isclass, module.__dict__.values())
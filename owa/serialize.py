@@ -0,0 +1,378 @@
+"""
+    openwebamp.serialize
+    ~~~~~~~~~~~~~~~~~~~~
+    Compiled dumping for the schemas in owa.schemas.
+
+    Schema.dump works everything out again for each object it's given: the
+    fields are filtered, every nested object gets its schema set up and
+    dumped through the whole machinery again, Polymorphic builds a schema per
+    item and every link is its own url_for call. Here a schema, as narrowed
+    by its only and exclude, is worked out once into a flat list of getters,
+    one for each field, and links are filled into URL templates that are
+    built once per request.
+
+    The getters only take shortcuts for the fields owa's schemas are made
+    of and only for values they know the answer for, everything else is
+    handed to the field's own serialize. Output is the same as Schema.dump's.
+"""
+from weakref import WeakKeyDictionary
+from flask import current_app, g, url_for
+from flask.ext.marshmallow.fields import (AbsoluteURLFor, Hyperlinks, URLFor,
+                                          _tpl)
+from marshmallow import missing
+from marshmallow.compat import basestring, text_type
+from marshmallow.decorators import POST_DUMP, PRE_DUMP
+from marshmallow.exceptions import ValidationError
+from marshmallow.fields import Field, Integer, List, Nested, Raw, String
+from marshmallow.utils import get_value, is_collection
+from .utils import Polymorphic, get_schema
+
+# values that can go into a URL template, anything else goes to url_for
+TEMPLATED = frozenset([int, text_type])
+RAW = frozenset([Field, Raw])
+
+# schema: {many: compiled}
+_compiled = WeakKeyDictionary()
+
+
+class URLTemplates(object):
+    """URLs built for one request. The first URL for an endpoint is built
+    with url_for from placeholder values, and split around them into a
+    template the real values are converted into with the rule's own
+    converters. The first real URL from a template is checked against
+    url_for and the template dropped if they differ.
+    """
+
+    def __init__(self):
+        self.templates = {}
+
+    @classmethod
+    def current(cls):
+        """The templates for the current request, made on first use.
+        """
+        urls = getattr(g, '_owa_urls', None)
+        if urls is None:
+            urls = g._owa_urls = cls()
+        return urls
+
+    def build(self, key, endpoint, params, names, values):
+        """Builds the URL for endpoint with params and names mapped to
+        values, same as url_for would.
+
+        :param key: Hashable that stands for endpoint, params and names
+        """
+        template = self.templates.get(key, missing)
+        if template is None:
+            return url_for(endpoint, **dict(params, **dict(zip(names,
+                                                               values))))
+        if template is not missing:
+            return template(values)
+
+        template = self.templates[key] = self.compile(endpoint, params, names)
+        url = url_for(endpoint, **dict(params, **dict(zip(names, values))))
+        if template is not None and template(values) != url:
+            self.templates[key] = None
+        return url
+
+    @staticmethod
+    def compile(endpoint, params, names):
+        """Makes a template for endpoint, or returns None if its URLs can't
+        be reliably built from one.
+
+        :returns callable: Takes values for names in order, returns the URL
+        """
+        if not names:
+            url = url_for(endpoint, **params)
+            return lambda values: url
+
+        rules = [rule for rule in current_app.url_map.iter_rules(endpoint)
+                 if set(names) <= rule.arguments]
+        if len(rules) != 1:
+            return None
+
+        try:
+            converters = [rules[0]._converters[name] for name in names]
+            markers = [_marker(converter, i)
+                       for i, converter in enumerate(converters)]
+            url = url_for(endpoint, **dict(params, **dict(zip(names,
+                                                              markers))))
+            encoded = [converter.to_url(marker)
+                       for converter, marker in zip(converters, markers)]
+        except Exception:
+            return None
+
+        if any(url.count(marker) != 1 for marker in encoded):
+            return None
+
+        found = sorted((url.index(marker), i, marker)
+                       for i, marker in enumerate(encoded))
+        parts, order, at = [], [], 0
+        for index, i, marker in found:
+            if index < at:
+                return None
+            parts.append(url[at:index])
+            order.append((i, converters[i]))
+            at = index + len(marker)
+        head, tail = parts[0], parts[1:] + [url[at:]]
+        steps = list(zip(order, tail))
+
+        def fill(values):
+            url = [head]
+            for (i, converter), part in steps:
+                url.append(converter.to_url(values[i]))
+                url.append(part)
+            return ''.join(url)
+        return fill
+
+
+def _marker(converter, i):
+    """A placeholder value the converter accepts.
+    """
+    for marker in (u'owa{}marker'.format(i), 7919000 + i):
+        try:
+            converter.to_url(marker)
+        except (TypeError, ValueError):
+            continue
+        return marker
+    raise ValueError('no placeholder for {!r}'.format(converter))
+
+
+def compilable(schema):
+    """Whether dumping with a schema can be compiled. Schemas with anything
+    that runs per object besides post_dump processors, or that raise on
+    errors rather than skip the field, can't be.
+    """
+    return not (schema.extra or schema.strict or schema.skip_missing or
+                schema.__accessor__ or schema.__data_handlers__ or
+                schema.__processors__[(PRE_DUMP, False)] or
+                schema.__processors__[(PRE_DUMP, True)])
+
+
+def _reader(key):
+    """Reads key off objects the same way marshmallow does, attributes
+    first.
+    """
+    if '.' in key:
+        return lambda obj: get_value(key, obj)
+
+    def read(obj):
+        if not isinstance(obj, dict):
+            value = getattr(obj, key, missing)
+            if value is not missing:
+                return value
+        return get_value(key, obj)
+    return read
+
+
+def _url(field, key):
+    """Converter for an URLFor, see _converter.
+    """
+    params, names, attrs = {}, [], []
+    for name, value in field.params.items():
+        attr = _tpl(str(value))
+        if attr:
+            names.append(name)
+            attrs.append(attr)
+        else:
+            params[name] = value
+    endpoint = field.endpoint
+    spec = (endpoint, frozenset(params.items()), tuple(names))
+
+    def convert(value, obj, urls):
+        values = [get_value(attr, obj) for attr in attrs]
+        if not all(type(v) in TEMPLATED for v in values):
+            # url_for turns down or raises on these, leave it to the field
+            return field._serialize(value, key, obj)
+        return urls.build(spec, endpoint, params, names, values)
+    return convert
+
+
+def _links(links, key):
+    """Converter for Hyperlinks' dict of links, see _converter.
+    """
+    if isinstance(links, dict):
+        items = [(name, _links(value, key)) for name, value in links.items()]
+        return lambda value, obj, urls: dict((name, convert(value, obj, urls))
+                                             for name, convert in items)
+    if type(links) in (URLFor, AbsoluteURLFor):
+        return _url(links, key)
+    if isinstance(links, URLFor):
+        return lambda value, obj, urls: links.serialize(key, obj)
+    return lambda value, obj, urls: links
+
+
+def _nested(schema, many=False):
+    """Converter for objects dumped with a nested schema, compiled once the
+    first one comes along.
+    """
+    plan = []
+
+    def convert(value, obj, urls):
+        if value is None:
+            return None
+        if not plan:
+            plan.append(compile_schema(schema, value, many=many))
+        if many:
+            return plan[0](list(value), urls)
+        return plan[0](value, urls)
+    return convert
+
+
+def _polymorphic(field):
+    """Converter for a Polymorphic field, with a compiled schema for each
+    class it comes across instead of a new schema for each object.
+    """
+    plans = {}
+
+    def convert(value, obj, urls):
+        if value is None:
+            return None
+        cls = value.__class__.__name__
+        plan = plans.get(cls)
+        if plan is None:
+            schema = field.mapping.get(cls, field.default_schema)
+            if isinstance(schema, basestring):
+                schema = get_schema(schema)
+            schema = schema(**field.nested_kwargs)
+            if compilable(schema):
+                plan = compile_schema(schema, value)
+            else:
+                def plan(value, urls):
+                    return schema.dump(value).data
+            plans[cls] = plan
+        return plan(value, urls)
+    return convert
+
+
+def _converter(field, key):
+    """Finds the shortcut for a field's _serialize.
+
+    :returns callable or None: Takes (value, obj, urls) and returns what
+    field._serialize(value, key, obj) would
+    """
+    kind = type(field)
+    if kind is Hyperlinks:
+        return _links(field.schema, key)
+    if kind is Nested and not isinstance(field.only, basestring):
+        schema = field.schema
+        if compilable(schema):
+            return _nested(schema, many=field.many)
+    if kind is Polymorphic:
+        return _polymorphic(field)
+    if kind is List and type(field.container) in (Nested, Polymorphic):
+        item = _converter(field.container, key)
+        if item is None:
+            return None
+
+        def convert(value, obj, urls):
+            if value is None:
+                return None
+            if not is_collection(value):
+                return field._serialize(value, key, obj)
+            return [item(each, obj, urls) for each in value]
+        return convert
+    return None
+
+
+def _getter(field, name):
+    """Makes a getter for a field, which returns what field.serialize(name,
+    obj) would, or missing when the field is to be left out.
+    """
+    kind = type(field)
+    read = _reader(field.attribute or name)
+
+    if kind in RAW:
+        def get(obj, urls):
+            value = read(obj)
+            return field.serialize(name, obj) if value is missing else value
+        return get
+
+    if kind is String or (kind is Integer and not field.as_string):
+        plain = text_type if kind is String else int
+
+        def get(obj, urls):
+            value = read(obj)
+            if value is None or type(value) is plain:
+                return value
+            return field.serialize(name, obj)
+        return get
+
+    convert = _converter(field, name)
+    if convert is None:
+        return lambda obj, urls: field.serialize(name, obj)
+
+    if kind is Hyperlinks:
+        # links are made from the object, there's no value to read
+        return lambda obj, urls: convert(missing, obj, urls)
+
+    def get(obj, urls):
+        value = read(obj)
+        if value is missing:
+            return field.serialize(name, obj)
+        return convert(value, obj, urls)
+    return get
+
+
+def compile_schema(schema, obj, many=False):
+    """Compiles dumping with schema, with the same fields it would dump obj
+    with.
+
+    :param schema: Schema instance, must be compilable
+    :param obj: Object, or list of objects if many, the fields are worked
+    out from
+    :returns callable: Takes the object, or list of objects, and a
+    URLTemplates and returns what schema.dump(obj, many=many).data would
+    """
+    fields = schema._update_fields(obj, many=many)
+    getters = [(schema.prefix + name, _getter(field, name))
+               for name, field in fields.items() if not field.load_only]
+    dict_class = schema.dict_class
+    each = [getattr(schema, attr)
+            for attr in schema.__processors__[(POST_DUMP, False)]]
+    raw = [getattr(schema, attr)
+           for attr in schema.__processors__[(POST_DUMP, True)]]
+
+    def dump_one(obj, urls):
+        items = []
+        for key, get in getters:
+            try:
+                value = get(obj, urls)
+            except ValidationError:
+                continue
+            if value is not missing:
+                items.append((key, value))
+        data = dict_class(items)
+        for processor in each:
+            result = processor(data)
+            data = data if result is None else result
+        return data
+
+    def dump(obj, urls):
+        if many:
+            data = [dump_one(o, urls) for o in obj]
+        else:
+            data = dump_one(obj, urls)
+        for processor in raw:
+            result = processor(data, many)
+            data = data if result is None else result
+        return data
+    return dump
+
+
+def dump(schema, obj, many=None):
+    """Dumps obj with schema, through a compiled version of it where that
+    can be done.
+
+    :returns: What schema.dump(obj, many=many).data would
+    """
+    many = schema.many if many is None else bool(many)
+    if many:
+        obj = list(obj)
+    if obj is None or (many and not obj) or not compilable(schema):
+        return schema.dump(obj, many=many).data
+
+    plans = _compiled.setdefault(schema, {})
+    plan = plans.get(many)
+    if plan is None:
+        plan = plans[many] = compile_schema(schema, obj, many=many)
+    return plan(obj, URLTemplates.current())
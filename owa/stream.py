@@ -1,13 +1,281 @@
-from flask import Blueprint, send_file, abort
-from .models import Track
+"""
+    openwebamp.stream
+    ~~~~~~~~~~~~~~~~~
+    Serves audio files, including byte ranges so players can seek without
+    starting the download over.
+
+    Which file a stream id points at is cached in process, so players
+    asking for range after range don't go back to the database each time.
+    A cached file is stat'ed before it's used, if it was moved or rewritten
+    since it was cached it's looked up again.
+"""
+import mimetypes
+import os
+from collections import namedtuple
+from datetime import datetime
+from threading import Lock
+from flask import Blueprint, abort, current_app, request
+from werkzeug.datastructures import EnvironHeaders
+from werkzeug.http import http_date, is_resource_modified, parse_range_header
+from werkzeug.wsgi import ClosingIterator, wrap_file
+from .models import db, Track
+from .readahead import read_ahead
+from .transcode import EncoderMissing, TranscodeError, current_transcoder
+from .utils import LRUCache
 
 Stream = Blueprint('stream', __name__, url_prefix='/stream')
 
+BLOCK_SIZE = 64 * 1024
+STREAM_CACHE_SIZE = 4096
+
+StreamFile = namedtuple('StreamFile', ['location', 'size', 'mtime',
+                                       'mimetype'])
+
+_streams = LRUCache(STREAM_CACHE_SIZE)
+_streams_lock = Lock()
+
+
+def forget_streams(uuids=None):
+    """Drops cached stream lookups, should be called when tracks are moved,
+    changed or removed.
+
+    :param uuids: Stream ids to forget, defaults to everything
+    """
+    with _streams_lock:
+        if uuids is None:
+            _streams.clear()
+        else:
+            for uuid in uuids:
+                _streams.pop(uuid)
+
+
+def _stat(location):
+    try:
+        return os.stat(location)
+    except OSError:
+        return None
+
+
+def find_stream(uuid):
+    """Finds the file behind a stream id. Only the track's location is
+    selected, and only when it isn't cached already.
+
+    :param uuid: Stream id of the track
+    :returns (StreamFile, stat) or None: None if there's no such track or
+    its file is gone
+    """
+    with _streams_lock:
+        found = _streams.get(uuid)
+
+    if found is not None:
+        stat = _stat(found.location)
+        if stat and (stat.st_size, int(stat.st_mtime)) == found[1:3]:
+            return found, stat
+        forget_streams([uuid])
+
+    location = db.session.query(Track.location)\
+        .filter(Track.uuid == uuid).scalar()
+    stat = location and _stat(location)
+    if not stat:
+        return None
+
+    found = StreamFile(location, stat.st_size, int(stat.st_mtime),
+                       mimetypes.guess_type(location)[0] or
+                       'application/octet-stream')
+    with _streams_lock:
+        _streams[uuid] = found
+    return found, stat
+
+
+def byte_range(header, size):
+    """Works out which bytes of a file a Range header asks for. Only a
+    single range is supported, anything else is answered with the whole
+    file, which is always allowed.
+
+    :param header: Value of the Range header
+    :param size: Size of the file in bytes
+    :returns (start, stop), None or False: stop is exclusive. None means
+    send the whole file, False means the range can't be satisfied.
+    """
+    parsed = parse_range_header(header)
+
+    if parsed is None or parsed.units != 'bytes' or len(parsed.ranges) != 1:
+        return None
+
+    start, stop = parsed.ranges[0]
+
+    if start < 0:
+        # suffix range, the last N bytes
+        start, stop = max(size + start, 0), size
+    else:
+        stop = size if stop is None else min(stop, size)
+
+    if start >= size:
+        return False
+    return start, stop
+
+
+def read_range(fh, length, block_size=BLOCK_SIZE):
+    """Yields length bytes from where a file is currently positioned and
+    closes it afterwards.
+    """
+    try:
+        while length > 0:
+            chunk = fh.read(min(block_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        fh.close()
+
+
+def stream_etag(uuid, stat):
+    """Strong entity tag for a track's file, changes whenever the file is
+    rewritten.
+    """
+    return '"{}-{:x}-{:x}"'.format(uuid, stat.st_size, int(stat.st_mtime))
+
+
+def plan_range(environ, stat, etag=None):
+    """Works out how to answer a request for a file from its Range and
+    conditional headers. A stale If-Range gets the whole file.
+
+    :param environ: WSGI environ of the request, or anything shaped like one
+    :param stat: Result of stat'ing the file
+    :param etag: Entity tag of the file, if there is one
+    :returns (status, headers, span): span is the (start, stop) of the file
+    to send, or None if no body should be sent
+    """
+    request_headers = EnvironHeaders(environ)
+    size = stat.st_size
+    modified = datetime.utcfromtimestamp(int(stat.st_mtime))
+    last_modified = http_date(modified)
+
+    wanted = None
+    if 'Range' in request_headers:
+        if_range = request_headers.get('If-Range')
+        if not if_range or if_range in (etag, last_modified):
+            wanted = byte_range(request_headers['Range'], size)
+
+    headers = {'Accept-Ranges': 'bytes', 'Last-Modified': last_modified}
+    if etag:
+        headers['ETag'] = etag
+
+    if not is_resource_modified(environ, etag=etag, last_modified=modified):
+        return 304, headers, None
+
+    if wanted is False:
+        headers['Content-Range'] = 'bytes */{}'.format(size)
+        return 416, headers, None
+
+    if wanted is None:
+        start, stop, status = 0, size, 200
+    else:
+        start, stop = wanted
+        status = 206
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1,
+                                                           size)
+
+    headers['Content-Length'] = str(stop - start)
+    return status, headers, (start, stop)
+
+
+def send_range(location, mimetype=None, etag=None, stat=None):
+    """Sends a file, or the part of it that the request's Range header asks
+    for. If-None-Match and If-Modified-Since are answered with a 304 without
+    opening the file.
+
+    Ranges that run to the end of the file (which is what players send
+    when seeking) are handed to the server's wsgi.file_wrapper from the
+    requested offset, so servers that use sendfile can send them without
+    copying. Ranges that end early are read out in blocks.
+
+    :param location: Path to the file
+    :param mimetype: Defaults to guessing from the file name
+    :param etag: Entity tag of the file, if there is one
+    :param stat: Result of stat'ing the file if that's been done already
+    """
+    stat = stat or os.stat(location)
+    mimetype = (mimetype or mimetypes.guess_type(location)[0] or
+                'application/octet-stream')
+    status, headers, span = plan_range(request.environ, stat, etag)
+
+    if span is None:
+        return current_app.response_class(status=status, headers=headers)
+
+    start, stop = span
+    fh = open(location, 'rb')
+    fh.seek(start)
+
+    if stop == stat.st_size:
+        body = wrap_file(request.environ, fh, BLOCK_SIZE)
+    else:
+        body = read_range(fh, stop - start)
+
+    return current_app.response_class(body, status=status, headers=headers,
+                                      mimetype=mimetype,
+                                      direct_passthrough=True)
+
+
+def send_transcoded(uuid, location, stat):
+    """Sends a track in the format and bitrate asked for with ?format= and
+    ?bitrate=. Finished transcodes are served from the cache, with ranges,
+    otherwise the output is sent as it's produced. The transcode is started
+    before the response is made, if it can't be that's a 503 when there's no
+    encoder to run and a 501 otherwise.
+    """
+    transcoder, cache = current_transcoder()
+    format = request.args['format']
+    bitrate = request.args.get('bitrate', transcoder.default_bitrate,
+                               type=int)
+    low, high = transcoder.bitrates
+
+    if format not in transcoder.formats or not low <= bitrate <= high:
+        abort(400)
+
+    key = cache.key(uuid, stat, format, bitrate,
+                    transcoder.settings(format, bitrate))
+    mimetype = transcoder.mimetype(format)
+    etag = '"{}"'.format(key)
+    cached = cache.get(key)
+
+    if cached:
+        return send_range(cached, mimetype=mimetype, etag=etag)
+
+    if not is_resource_modified(request.environ, etag=etag):
+        return current_app.response_class(status=304, headers={'ETag': etag})
+
+    try:
+        output = transcoder.transcode(location, format, bitrate)
+    except EncoderMissing:
+        abort(503)
+    except TranscodeError:
+        abort(501)
+
+    # the store may never be iterated, e.g. for HEAD, so the output is
+    # closed along with the response either way
+    chunks = ClosingIterator(cache.store(key, output),
+                             getattr(output, 'close', None))
+    return current_app.response_class(chunks, mimetype=mimetype,
+                                      headers={'ETag': etag},
+                                      direct_passthrough=True)
+
 
 @Stream.route('/<stream>')
 def stream(stream):
-    track = Track.query.filter(Track.uuid == stream).first()
-    if not track:
+    found = find_stream(stream)
+    if not found:
         abort(404)
 
-    return send_file(track.location)
+    tracklist = request.args.get('tracklist', type=int)
+    position = request.args.get('position', type=int)
+    if tracklist is not None and position is not None:
+        read_ahead(tracklist, position)
+
+    found, stat = found
+    if 'format' in request.args:
+        return send_transcoded(stream, found.location, stat)
+
+    return send_range(found.location, mimetype=found.mimetype,
+                      etag=stream_etag(stream, stat), stat=stat)
@@ -0,0 +1,254 @@
+"""
+    openwebamp.streamserver
+    ~~~~~~~~~~~~~~~~~~~~~~~
+    A standalone server for /stream/<uuid> built on asyncio, so listeners
+    don't tie up the Flask app's workers for as long as a track plays.
+
+    Requests are answered exactly like the Flask view answers them, ranges
+    and conditional requests included, since both go through plan_range.
+    Stream ids are looked up with find_stream, and files opened, on a small
+    thread pool, so neither the database nor a slow mount blocks the event
+    loop, and files are sent with sendfile where the platform has it.
+    Connections are kept alive between requests, which is what players
+    seeking through a track do, request bodies are read past so they don't
+    get in the way of the next request.
+
+    Transcoding isn't done here, ?format= requests should go to the Flask
+    app.
+
+    Needs Python 3.5 or later.
+"""
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+from werkzeug.http import http_date
+from .models import db
+from .readahead import read_ahead
+from .stream import BLOCK_SIZE, find_stream, plan_range, stream_etag
+
+STREAM_PATH = re.compile(r'^/stream/([^/]+)$')
+REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified',
+           400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           416: 'Requested Range Not Satisfiable', 501: 'Not Implemented'}
+MAX_HEADERS = 64 * 1024
+
+
+class BadRequest(Exception):
+    pass
+
+
+def parse_request(head):
+    """Turns the head of an HTTP request into a WSGI shaped environ, which
+    is all plan_range needs.
+
+    :param head: Bytes of the request line and headers
+    :returns dict:
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise BadRequest(lines[0])
+
+    url = urlsplit(target)
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': url.path,
+               'QUERY_STRING': url.query, 'SERVER_PROTOCOL': version}
+
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise BadRequest(line)
+        key = name.strip().upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = value.strip()
+    return environ
+
+
+def keep_alive(environ):
+    connection = environ.get('HTTP_CONNECTION', '').lower()
+    if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+class StreamServer(object):
+    """Serves /stream/<uuid> for an app.
+
+    :param app: The Flask app whose database holds the tracks
+    :param lookups: Number of threads to look stream ids up with
+    :param idle: Seconds to hold an idle connection open for
+    """
+
+    def __init__(self, app, lookups=4, idle=60):
+        self.app = app
+        self.idle = idle
+        self.executor = ThreadPoolExecutor(lookups)
+
+    def find(self, uuid, context=None):
+        with self.app.app_context():
+            try:
+                found = find_stream(uuid)
+                if found and context:
+                    read_ahead(*context)
+                return found
+            finally:
+                db.session.remove()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'), self.idle)
+                except (asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+
+                try:
+                    environ = parse_request(head)
+                except BadRequest:
+                    self.respond(writer, 400, {'Connection': 'close'})
+                    break
+
+                try:
+                    reusable = await self.skip_body(reader, environ)
+                except BadRequest:
+                    self.respond(writer, 400, {'Connection': 'close'})
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+
+                alive = reusable and keep_alive(environ)
+                await self.serve(loop, environ, writer, alive)
+                await writer.drain()
+                if not alive:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def skip_body(self, reader, environ):
+        """Reads past a request's body, so the next request on the connection
+        is read from where it starts. Nothing served here takes a body, it's
+        thrown away.
+
+        :returns bool: False if the end of the body can't be found, the
+        connection can't be reused then.
+        """
+        if 'HTTP_TRANSFER_ENCODING' in environ:
+            return False
+        try:
+            remaining = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise BadRequest(environ['CONTENT_LENGTH'])
+        if remaining < 0:
+            raise BadRequest(environ['CONTENT_LENGTH'])
+
+        while remaining > 0:
+            chunk = await asyncio.wait_for(
+                reader.read(min(BLOCK_SIZE, remaining)), self.idle)
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(chunk)
+        return True
+
+    async def serve(self, loop, environ, writer, alive):
+        headers = {'Connection': 'keep-alive' if alive else 'close'}
+        method = environ['REQUEST_METHOD']
+        match = STREAM_PATH.match(environ['PATH_INFO'])
+
+        if not match:
+            return self.respond(writer, 404, headers)
+        if method not in ('GET', 'HEAD'):
+            headers['Allow'] = 'GET, HEAD'
+            return self.respond(writer, 405, headers)
+        query = parse_qs(environ['QUERY_STRING'])
+        if 'format' in query:
+            return self.respond(writer, 501, headers)
+
+        try:
+            context = (int(query['tracklist'][0]), int(query['position'][0]))
+        except (KeyError, ValueError):
+            context = None
+
+        uuid = match.group(1)
+        found = await loop.run_in_executor(self.executor, self.find, uuid,
+                                           context)
+        if not found:
+            return self.respond(writer, 404, headers)
+
+        found, stat = found
+        status, extra, span = plan_range(environ, stat,
+                                         stream_etag(uuid, stat))
+        headers.update(extra)
+
+        if span is None or method == 'HEAD':
+            if span is not None:
+                headers['Content-Type'] = found.mimetype
+            return self.respond(writer, status, headers)
+
+        try:
+            # opening can block as long as a lookup on a network mount
+            fh = await loop.run_in_executor(self.executor, open,
+                                            found.location, 'rb')
+        except OSError:
+            return self.respond(writer, 404, headers)
+
+        with fh:
+            headers['Content-Type'] = found.mimetype
+            self.respond(writer, status, headers)
+            start, stop = span
+            await self.send_file(loop, writer, fh, start, stop - start)
+
+    def respond(self, writer, status, headers):
+        """Writes a status line and headers. Responses without a body are
+        given a Content-Length of 0 so the connection can be reused.
+        """
+        headers.setdefault('Content-Length', '0')
+        headers['Date'] = http_date()
+        lines = ['HTTP/1.1 {} {}'.format(status, REASONS[status])]
+        lines.extend('{}: {}'.format(k, v) for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def send_file(self, loop, writer, fh, offset, count):
+        """Sends count bytes of fh from offset. loop.sendfile (3.7+) uses
+        os.sendfile when it can and falls back to reading the file itself,
+        before that the file is read on the thread pool.
+        """
+        await writer.drain()
+        if hasattr(loop, 'sendfile'):
+            await loop.sendfile(writer.transport, fh, offset, count)
+            return
+
+        fh.seek(offset)
+        while count > 0:
+            chunk = await loop.run_in_executor(
+                self.executor, fh.read, min(BLOCK_SIZE, count))
+            if not chunk:
+                break
+            count -= len(chunk)
+            writer.write(chunk)
+            await writer.drain()
+
+    def run(self, host='127.0.0.1', port=5001):
+        """Serves until interrupted.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(
+            self.handle, host, port, limit=MAX_HEADERS))
+        print(' * Streaming on http://{}:{}/stream/'.format(host, port))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.executor.shutdown()
@@ -0,0 +1,78 @@
+"""
+    openwebamp.tagcache
+    ~~~~~~~~~~~~~~~~~~~
+    On disk cache of adaptor output.
+
+    Reading tags means opening every audio file, which hurts on network
+    storage. The cache is a small SQLite file keyed by path and checked
+    against the file's size and mtime, so rebuilding the database from an
+    unchanged library mostly reads from here instead.
+"""
+import json
+import sqlite3
+
+
+class TagCache(object):
+    """Maps a file location to what was parsed out of it, as long as the
+    file's size and mtime haven't changed since. Failures are cached too so
+    broken files aren't opened on every run.
+
+    Each process should open its own TagCache. Writes from several
+    processes are serialized by SQLite.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS parsed ('
+                          'location TEXT PRIMARY KEY, '
+                          'size INTEGER, '
+                          'mtime INTEGER, '
+                          'info TEXT, '
+                          'error TEXT)')
+        self.conn.commit()
+
+    def get(self, location, size, mtime):
+        """Looks up a file.
+
+        :returns (info, error) or None if the file isn't cached or has
+        changed:
+        """
+        row = self.conn.execute('SELECT info, error FROM parsed '
+                                'WHERE location = ? AND size = ? '
+                                'AND mtime = ?',
+                                (location, size, mtime)).fetchone()
+        if row is None:
+            return None
+
+        info, error = row
+        return (json.loads(info) if info else None), error
+
+    def put_many(self, entries):
+        """Stores parse results, replacing anything previously stored for
+        the same location.
+
+        :param entries: Iterable of (location, size, mtime, info, error)
+        """
+        rows = [(location, size, mtime,
+                 json.dumps(info) if info is not None else None, error)
+                for location, size, mtime, info, error in entries]
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO parsed '
+                                  'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.conn.close()
+
+
+_open_caches = {}
+
+
+def open_cache(path):
+    """Opens a cache once per process and hands back the same one after
+    that. Worker processes are given the path rather than a connection.
+    """
+    if path not in _open_caches:
+        _open_caches[path] = TagCache(path)
+    return _open_caches[path]
@@ -0,0 +1,231 @@
+"""
+    openwebamp.transcode
+    ~~~~~~~~~~~~~~~~~~~~
+    Turns tracks into other formats and bitrates for clients that can't, or
+    shouldn't, pull the original file.
+
+    Output is sent to the client as it's produced and written to an on disk
+    cache at the same time. Once a transcode finishes, later requests for it
+    are served from the cache like any other file, ranges and all. The cache
+    is bounded by size, the least recently used files are removed first.
+
+    Which transcoder is used is set with the TRANSCODER config value, any
+    subclass of Transcoder can be named there.
+"""
+import os
+import subprocess
+from hashlib import sha1
+from tempfile import mkstemp
+from flask import current_app
+from werkzeug.utils import import_string
+
+BLOCK_SIZE = 64 * 1024
+
+
+class TranscodeError(Exception):
+    pass
+
+
+class EncoderMissing(TranscodeError):
+    """The encoder a transcoder relies on can't be run at all.
+    """
+
+
+class Transcoder(object):
+    """Base for transcoders. Subclasses list the formats they can produce,
+    mapped to the mimetype they're sent with, and implement transcode.
+    """
+    formats = {}
+    default_bitrate = 128
+    bitrates = (32, 320)
+
+    def mimetype(self, format):
+        return self.formats[format]
+
+    def settings(self, format, bitrate):
+        """Describes what produces a transcode besides the original file,
+        it's part of the transcode's cache key so switching transcoders, or
+        changing how one is set up, doesn't serve what the old one made.
+
+        :returns str:
+        """
+        cls = type(self)
+        return '{}.{}'.format(cls.__module__, cls.__name__)
+
+    def transcode(self, location, format, bitrate):
+        """Produces the file at location in another format.
+
+        :param location: Path to the original file
+        :param format: One of the formats this transcoder lists
+        :param bitrate: Target bitrate in kbps
+        :returns iterator of bytes:
+        :raises TranscodeError: If the transcode can't be started, this is
+        raised by transcode itself rather than once the output is read
+        """
+        raise NotImplementedError
+
+
+class PassThrough(Transcoder):
+    """Sends the original file as it is, whatever was asked for. Useful for
+    testing and for setups without an encoder.
+    """
+    formats = {'mp3': 'audio/mpeg', 'ogg': 'audio/ogg', 'opus': 'audio/ogg'}
+
+    def transcode(self, location, format, bitrate):
+        with open(location, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(BLOCK_SIZE), b''):
+                yield chunk
+
+
+class FFmpegTranscoder(Transcoder):
+    """Runs a local ffmpeg and reads its output from a pipe. If the client
+    goes away before the output is done, the encoder is killed.
+    """
+    executable = 'ffmpeg'
+    formats = {'mp3': 'audio/mpeg', 'ogg': 'audio/ogg', 'opus': 'audio/ogg'}
+    # format: (codec, container)
+    codecs = {'mp3': ('libmp3lame', 'mp3'), 'ogg': ('libvorbis', 'ogg'),
+              'opus': ('libopus', 'ogg')}
+
+    def command(self, location, format, bitrate):
+        codec, container = self.codecs[format]
+        return [self.executable, '-nostdin', '-v', 'error', '-i', location,
+                '-map', '0:a:0', '-c:a', codec, '-b:a', '{}k'.format(bitrate),
+                '-f', container, 'pipe:1']
+
+    def settings(self, format, bitrate):
+        command = self.command('', format, bitrate)
+        return ' '.join([super(FFmpegTranscoder, self).settings(
+            format, bitrate)] + command)
+
+    def transcode(self, location, format, bitrate):
+        try:
+            proc = subprocess.Popen(self.command(location, format, bitrate),
+                                    stdout=subprocess.PIPE)
+        except OSError as e:
+            raise EncoderMissing('Could not run {}: {}'.format(
+                self.executable, e))
+        return EncoderOutput(proc, self.executable)
+
+
+class EncoderOutput(object):
+    """Reads a running encoder's output. Closing it stops the encoder,
+    whether or not the output was read at all.
+    """
+
+    def __init__(self, proc, executable):
+        self.proc = proc
+        self.executable = executable
+
+    def __iter__(self):
+        proc = self.proc
+        try:
+            for chunk in iter(lambda: proc.stdout.read(BLOCK_SIZE), b''):
+                yield chunk
+            if proc.wait():
+                raise TranscodeError('{} exited with {}'.format(
+                    self.executable, proc.returncode))
+        finally:
+            self.close()
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class TranscodeCache(object):
+    """Finished transcodes on disk, kept under max_size bytes in total.
+    Files are touched whenever they're served, so their mtime doubles as
+    when they were last used.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(uuid, stat, format, bitrate, settings=''):
+        """Names a transcode. The original file's size and mtime are part of
+        it, so rewriting the original doesn't serve a stale transcode.
+
+        :param settings: The transcoder's settings for the format and bitrate
+        """
+        parts = (uuid, stat.st_size, int(stat.st_mtime), bitrate, settings)
+        name = sha1('-'.join(map(str, parts)).encode('utf-8')).hexdigest()
+        return '{}.{}'.format(name, format)
+
+    def get(self, key):
+        """Returns the path to a finished transcode or None.
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def store(self, key, chunks):
+        """Writes chunks to the cache while passing them on. Nothing is
+        cached unless every chunk made it through.
+        """
+        fd, partial = mkstemp(dir=self.directory, suffix='.part')
+        done = False
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+                    yield chunk
+            done = True
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            if done:
+                os.rename(partial, os.path.join(self.directory, key))
+                self.evict()
+            else:
+                os.remove(partial)
+
+    def evict(self):
+        """Removes the least recently used transcodes until the cache fits.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.part'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def current_transcoder():
+    """Returns the app's transcoder and cache, created on first use.
+
+    :returns (Transcoder, TranscodeCache):
+    """
+    ext = current_app.extensions.get('owa_transcode')
+    if ext is None:
+        config = current_app.config
+        transcoder = config['TRANSCODER']
+        if not callable(transcoder):
+            transcoder = import_string(transcoder)
+        cache = TranscodeCache(config['TRANSCODE_CACHE_DIR'],
+                               config['TRANSCODE_CACHE_SIZE'])
+        ext = current_app.extensions['owa_transcode'] = (transcoder(), cache)
+    return ext
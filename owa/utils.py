@@ -4,10 +4,23 @@
 
     Internal utilities for OpenWebAmp
 """
+import json
+import os
+import sys
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
 from flask import request
 from marshmallow.fields import Field
 from marshmallow.class_registry import get_class as get_schema
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+UNIQUE_CACHE_SIZE = 4096
+
 
 def get_page_and_limit(request=request):
     page = request.args.get('page', default=1, type=int)
@@ -15,6 +28,124 @@ def get_page_and_limit(request=request):
     return page, limit
 
 
+def get_fields(request=request):
+    """Reads ?fields= as a comma separated list of field names.
+
+    :returns tuple or None: The names, sorted, or None if there weren't any
+    """
+    fields = request.args.get('fields', default='')
+    names = set(name.strip() for name in fields.split(','))
+    names.discard('')
+    return tuple(sorted(names)) or None
+
+
+def encode_cursor(*values):
+    """Packs the sort key of the last item on a page into an opaque string
+    that can be sent back for the page after it.
+    """
+    packed = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return urlsafe_b64encode(packed).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Unpacks a cursor made by encode_cursor.
+
+    :returns list: The values the cursor was made from
+    :raises ValueError: If the cursor wasn't made by encode_cursor
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(urlsafe_b64decode(padded.encode('ascii'))
+                            .decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('invalid cursor: {!r}'.format(cursor))
+    if not isinstance(values, list):
+        raise ValueError('invalid cursor: {!r}'.format(cursor))
+    return values
+
+
+def chunked(items, size=500):
+    """Splits a sequence into lists of at most size items. Useful for keeping
+    IN clauses under the bound parameter limits of some databases.
+
+    :param items: Iterable to split up
+    :param size: Maximum length of each chunk
+    """
+    items = list(items)
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+def under(column, directory):
+    """Filter for paths in column that are inside directory. LIKE wildcards
+    in the directory are escaped, so a % or _ in a path only matches itself.
+    """
+    prefix = directory.rstrip(os.sep) + os.sep
+    for char in ('\\', '%', '_'):
+        prefix = prefix.replace(char, '\\' + char)
+    return column.startswith(prefix, escape='\\')
+
+
+class LRUCache(object):
+    """A mapping that only holds on to the maxsize most recently used items,
+    the least recently used item is dropped when a new one is added to a
+    full cache.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, key):
+        value = self._items.pop(key)
+        self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def oldest(self):
+        """The least recently used value, the next one to be dropped, or None
+        if the cache is empty.
+        """
+        return next(iter(self._items.values()), None)
+
+    def pop(self, key, default=None):
+        return self._items.pop(key, default)
+
+    def values(self):
+        return list(self._items.values())
+
+    def clear(self):
+        self._items.clear()
+
+
+def peak_rss():
+    """Reports the peak resident memory of the current process in bytes,
+    or None where the resource module isn't available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, OS X reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
 def _unique(session, cls, hashfunc, queryfunc, constructor, *args, **kwargs):
     """Codifies the find_or_create behavior needed for certain lookups that
     either find an item in the database or create a new one.
@@ -29,13 +160,18 @@ def _unique(session, cls, hashfunc, queryfunc, constructor, *args, **kwargs):
     :param kwargs: optional keywords to pass to the hashfunc, queryfunc and
     constructor
 
+    The cache lives in the session's info dictionary, so it goes away with
+    the session, and is bounded to UNIQUE_CACHE_SIZE entries. A pending
+    object that fell out of it couldn't be found by queryfunc and would be
+    created a second time, so the session is flushed before one is dropped.
+
     Source:
     https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/UniqueObject
     """
-    cache = getattr(session, '_unique_cache', None)
+    cache = session.info.get('_unique_cache')
 
     if cache is None:
-        session._unique_cache = cache = {}
+        session.info['_unique_cache'] = cache = LRUCache(UNIQUE_CACHE_SIZE)
 
     key = (cls, hashfunc(*args, **kwargs))
 
@@ -50,10 +186,24 @@ def _unique(session, cls, hashfunc, queryfunc, constructor, *args, **kwargs):
                 obj = constructor(*args, **kwargs)
                 session.add(obj)
 
+        if len(cache) >= cache.maxsize and cache.oldest() in session.new:
+            session.flush()
         cache[key] = obj
         return obj
 
 
+def release_session(session):
+    """Drops everything from a session except what's held by the
+    find_or_create cache, which keeps a long running session from growing
+    with every object it's ever loaded. Only call this once everything has
+    been committed.
+    """
+    cache = session.info.get('_unique_cache')
+    session.expunge_all()
+    if cache:
+        session.add_all(cache.values())
+
+
 class UniqueMixin(object):
     """Implements the _unique function as a class mixin.
     """
@@ -0,0 +1,319 @@
+"""
+    openwebamp.watch
+    ~~~~~~~~~~~~~~~~
+    Keeps the database in step with library directories as files come and go.
+
+    Changes are picked up with inotify when pyinotify is installed, otherwise
+    directory mtimes are polled. Either way, bursts of changes (like an album
+    being copied in) are gathered up until things settle down and are then
+    handed to the same parse and store pipeline addfiles uses.
+"""
+from __future__ import print_function
+import os
+import sys
+from stat import S_ISDIR
+from time import sleep
+from sqlalchemy.exc import IntegrityError
+from .cli import (valid_file_exts, adaptor, filter_files, load_manifest,
+                  parse_groups, prune_tracks, skip_unchanged, store_group)
+from .core import location_hash
+from .models import db, Track
+from .reconcile import find_missing, relocate
+from .utils import under
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _file_stats(directory):
+    """The size and mtime of every file in a directory, or None if it can't
+    be listed.
+    """
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return None
+    stats = {}
+    for entry in entries:
+        try:
+            stat = os.stat(os.path.join(directory, entry))
+        except OSError:
+            continue
+        if not S_ISDIR(stat.st_mode):
+            stats[entry] = (stat.st_size, stat.st_mtime)
+    return stats
+
+
+class PollingWatcher(object):
+    """Watches the mtime of every directory under the roots. Adding,
+    removing or renaming an entry updates the mtime of the directory that
+    holds it, so one stat per directory is enough to notice those. Files
+    rewritten in place don't touch their directory and are left for the next
+    incremental rescan.
+
+    A file that's still being copied doesn't touch its directory either, so
+    once a directory has changed the size and mtime of its files are
+    watched too, and it's reported as changed again until they stop
+    changing. That keeps a batch from settling while files are half written.
+
+    Like every watcher, poll returns a set of (directory, recursive) pairs.
+    Directories that appeared or vanished need their whole tree synced,
+    others only need their own files looked at.
+    """
+
+    def __init__(self, roots, interval=5):
+        self.interval = interval
+        self.mtimes = {}
+        # directory: {name: (size, mtime)} for directories that just changed
+        self.files = {}
+        for root in roots:
+            self._snapshot(root)
+
+    def _snapshot(self, top, files=False):
+        for current, _, _ in os.walk(top):
+            self.mtimes[current] = _mtime(current)
+            if files:
+                self.files[current] = _file_stats(current) or {}
+
+    def _growing(self):
+        """Directories whose files changed since the last poll.
+        """
+        growing = set()
+        for directory, known in list(self.files.items()):
+            current = _file_stats(directory)
+            if current is None or current == known:
+                del self.files[directory]
+            else:
+                self.files[directory] = current
+                growing.add((directory, False))
+        return growing
+
+    def poll(self, timeout):
+        sleep(max(timeout, self.interval))
+        changed = self._growing()
+
+        for directory, mtime in list(self.mtimes.items()):
+            current = _mtime(directory)
+
+            if current == mtime:
+                continue
+
+            if current is None:
+                del self.mtimes[directory]
+                changed.add((directory, True))
+                continue
+
+            self.mtimes[directory] = current
+            changed.add((directory, False))
+            try:
+                entries = os.listdir(directory)
+            except OSError:
+                # removed since it was stat'ed, the next poll picks that up
+                continue
+            self.files[directory] = _file_stats(directory) or {}
+            for entry in entries:
+                path = os.path.join(directory, entry)
+                if os.path.isdir(path) and path not in self.mtimes:
+                    self._snapshot(path, files=True)
+                    changed.add((path, True))
+
+        return changed
+
+
+class InotifyWatcher(object):
+    """Has the kernel report changes through inotify. New directories are
+    watched as they appear.
+    """
+
+    def __init__(self, roots):
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+                pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO)
+        self.changed = set()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self._record)
+        for root in roots:
+            self.manager.add_watch(root, mask, rec=True, auto_add=True)
+
+    def _record(self, event):
+        if event.dir:
+            self.changed.add((event.pathname, True))
+        else:
+            self.changed.add((event.path, False))
+
+    def poll(self, timeout):
+        if self.notifier.check_events(int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+        changed, self.changed = self.changed, set()
+        return changed
+
+
+def make_watcher(roots, interval=5, polling=False):
+    """Uses inotify if it's available, otherwise falls back to polling.
+    """
+    if pyinotify and not polling:
+        return InotifyWatcher(roots)
+    return PollingWatcher(roots, interval=interval)
+
+
+def settled(watcher, settle=2):
+    """Gathers changes from a watcher and yields them once no new changes
+    have been seen for settle seconds.
+
+    :yields {(directory, recursive)}:
+    """
+    pending = set()
+    while True:
+        changed = watcher.poll(settle)
+        if changed:
+            pending.update(changed)
+        elif pending:
+            yield pending
+            pending = set()
+
+
+def _plan(changed):
+    """Drops anything that's already covered by syncing a tree it's inside
+    of, or by syncing the same directory recursively.
+
+    :returns [(directory, recursive)]:
+    """
+    trees = []
+    for directory in sorted(d for d, recursive in changed if recursive):
+        if not trees or not directory.startswith(trees[-1] + os.sep):
+            trees.append(directory)
+
+    def covered(directory):
+        return any(directory == tree or directory.startswith(tree + os.sep)
+                   for tree in trees)
+
+    shallow = sorted(d for d, recursive in changed
+                     if not recursive and not covered(d))
+    return [(d, True) for d in trees] + [(d, False) for d in shallow]
+
+
+def _commit():
+    try:
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        print('***Error encountered: {!s}'.format(e), file=sys.stderr)
+
+
+def _guarded(func, *args, **kwargs):
+    """Runs one step of a sync. If it fails the error is reported and its
+    changes are rolled back, but the watch carries on, the directory is
+    looked at again the next time it changes.
+    """
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        db.session.rollback()
+        print('***Error syncing: {}: {!s}'.format(e.__class__.__name__, e),
+              file=sys.stderr)
+
+
+def _own_files(directory, valid_exts):
+    files = sorted(f for f in os.listdir(directory) if f.endswith(valid_exts))
+    return [[os.path.join(directory, f) for f in files]]
+
+
+def _files(directory, recursive, valid_exts):
+    if recursive:
+        return list(filter_files(directory, valid_exts))
+    return _own_files(directory, valid_exts)
+
+
+def relocate_moves(plan, valid_exts=valid_file_exts):
+    """Moving a directory shows up as one directory vanishing and another
+    appearing. Before either is synced, tracks that went missing are matched
+    against the files that appeared so they're moved rather than pruned and
+    stored all over again.
+    """
+    missing = find_missing(prefixes=[d for d, _ in plan])
+    if not missing:
+        return
+
+    candidates = [f for d, recursive in plan if os.path.isdir(d)
+                  for group in _files(d, recursive, valid_exts)
+                  for f in group]
+    manifest = load_manifest(locations=candidates)
+    candidates = [f for f in candidates if location_hash(f) not in manifest]
+    moved, _ = relocate(missing, candidates)
+
+    for track, location in moved:
+        print('* Moved: {} -> {}'.format(track.location, location))
+    _commit()
+
+
+def sync_directory(directory, recursive=True, valid_exts=valid_file_exts,
+                   adaptor=adaptor, bulk=False):
+    """Brings the stored tracks in a directory in line with what's on disk.
+    Tracks whose files are gone are pruned, new and changed files are stored
+    and unchanged files are skipped without being opened.
+
+    :param directory: Directory to sync
+    :param recursive: Sync everything under the directory rather than only
+    the files directly inside of it
+    """
+    stored = db.session.query(Track.id, Track.location)\
+        .filter(under(Track.location, directory))
+    gone = [id for id, location in stored
+            if (recursive or os.path.dirname(location) == directory) and
+            not os.path.exists(location)]
+
+    if gone:
+        prune_tracks(Track.query.filter(Track.id.in_(gone)).all())
+        print('* Removed {} missing tracks under {}'.format(
+            len(gone), directory))
+        _commit()
+
+    if not os.path.isdir(directory):
+        return
+
+    groups = _files(directory, recursive, valid_exts)
+    manifest = load_manifest(locations=[f for g in groups for f in g])
+    for group in parse_groups(skip_unchanged(groups, manifest), adaptor):
+        store_group(group, incremental=True, bulk=bulk)
+        _commit()
+
+
+def watch(roots, valid_exts=valid_file_exts, adaptor=adaptor, settle=2,
+          interval=5, polling=False, bulk=False, watcher=None):
+    """Watches library roots forever, syncing directories as they change.
+
+    :param roots: Iterable of directories to watch
+    :param valid_exts: Iterable of extensions to match against
+    :param adaptor: Callable that transforms a mutagen file into a dict
+    :param settle: Seconds without changes before a batch is synced
+    :param interval: Seconds between scans when polling
+    :param polling: Poll even if inotify is available
+    :param bulk: Store new tracks with set based inserts
+    :param watcher: Object with a poll(timeout) method returning a set of
+    changed (directory, recursive) pairs, built with make_watcher if not
+    provided
+    """
+    roots = [os.path.abspath(r) for r in roots]
+    watcher = watcher or make_watcher(roots, interval, polling)
+    print('Watching {} with {}'.format(', '.join(roots),
+                                       watcher.__class__.__name__))
+
+    for changed in settled(watcher, settle):
+        plan = _plan(changed)
+        print('Syncing {} directories'.format(len(plan)))
+        _guarded(relocate_moves, plan, valid_exts)
+        for directory, recursive in plan:
+            _guarded(sync_directory, directory, recursive, valid_exts,
+                     adaptor, bulk=bulk)
+        db.session.remove()
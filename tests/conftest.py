@@ -0,0 +1,111 @@
+"""
+    tests.conftest
+    ~~~~~~~~~~~~~~
+    Fixtures shared by the test suite.
+
+    Audio files are stood in for by small JSON files holding their tags,
+    which are read in place of mutagen, so no real audio is needed.
+"""
+import io
+import json
+import os
+import pytest
+from owa import after_request, cli, config, create_app, db
+from owa.api import api
+from owa.download import Download
+from owa.stream import Stream, forget_streams
+
+
+class TestingConfig(config.BaseConfig):
+    TESTING = True
+    SERVER_NAME = 'localhost'
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+
+class FakeInfo(object):
+    def __init__(self, length):
+        self.length = length
+
+
+class FakeFile(dict):
+    """Looks enough like an easy mutagen file for the adaptor.
+    """
+
+    def __init__(self, filename, tags, length):
+        super(FakeFile, self).__init__(
+            (k, v if isinstance(v, list) else [v]) for k, v in tags.items())
+        self.filename = filename
+        self.info = FakeInfo(length)
+
+
+def open_fake(filepath, easy=True):
+    with io.open(filepath, encoding='utf-8') as fh:
+        data = json.load(fh)
+    return FakeFile(filepath, data['tags'], data['length'])
+
+
+class Library(object):
+    """A directory of fake audio files laid out as Artist/Album/Title.mp3
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def add(self, artist, album, title, genres=('rock',), length=180,
+            padding=0):
+        directory = os.path.join(self.root, artist, album)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, title + '.mp3')
+        self.write(path, artist, album, title, genres, length, padding)
+        return path
+
+    @staticmethod
+    def write(path, artist, album, title, genres=('rock',), length=180,
+              padding=0):
+        data = dict(tags=dict(artist=artist, album=album, title=title,
+                              genre=list(genres)),
+                    length=length, padding='.' * padding)
+        with io.open(path, 'w', encoding='utf-8') as fh:
+            fh.write(json.dumps(data, ensure_ascii=False))
+
+    def fill(self, artists=2, albums=2, tracks=3):
+        for a in range(artists):
+            for b in range(albums):
+                for t in range(tracks):
+                    self.add(u'Artist {}'.format(a), u'Album {}'.format(b),
+                             u'{:02d} Track'.format(t),
+                             genres=('rock', u'genre {}'.format(a)),
+                             length=180 + t)
+        return self
+
+    def store(self, **kwargs):
+        return cli.store_directory(self.root, **kwargs)
+
+
+@pytest.fixture
+def app(request):
+    app = create_app('owa', config=TestingConfig, exts=[db, api],
+                     bps=[Stream, Download], after=after_request)
+    ctx = app.app_context()
+    ctx.push()
+    db.create_all()
+
+    def teardown():
+        db.session.remove()
+        db.drop_all()
+        forget_streams()
+        ctx.pop()
+    request.addfinalizer(teardown)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def library(app, tmpdir, monkeypatch):
+    monkeypatch.setattr(cli, 'File', open_fake)
+    return Library(str(tmpdir.mkdir('library')))
@@ -0,0 +1,37 @@
+import io
+import os
+import zipfile
+from owa.download import ZipEntry, ZipStream
+from owa.models import Album
+
+
+def test_album_download(client, library):
+    paths = [library.add(u'Artist', u'Album', u'{:02d}'.format(i),
+                         padding=i * 100) for i in range(3)]
+    library.store()
+    album = Album.query.one()
+
+    response = client.get('/album/{}/download'.format(album.id))
+
+    assert int(response.headers['Content-Length']) == len(response.data)
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.testzip() is None
+    for number, path in enumerate(paths, 1):
+        with io.open(path, 'rb') as fh:
+            name = u'{:02d} - {}'.format(number, os.path.basename(path))
+            assert archive.read(name) == fh.read()
+
+
+def test_zip64_for_many_entries(tmpdir):
+    # more entries than a plain zip can count
+    path = tmpdir.join('empty.mp3')
+    path.write('')
+    entries = [ZipEntry(u'{}.mp3'.format(i), str(path), 0, 0)
+               for i in range(0xFFFF + 1)]
+    body = ZipStream(entries)
+
+    data = b''.join(body)
+
+    assert len(body) == len(data)
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert len(archive.infolist()) == len(entries)
@@ -0,0 +1,226 @@
+import os
+import pytest
+from owa import cli, db, utils
+from owa.instrument import IngestStats
+from owa.models import Album, Artist, Tag, Track
+
+
+def reset():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def snapshot(ordered=True):
+    """Everything an import leaves behind, without ids or uuids.
+
+    :param ordered: Compare the order of tracks on albums too
+    """
+    albums = sorted((album.name, album.artist.name, album.track_count,
+                     album.duration,
+                     [t.location for t in album.tracks] if ordered else
+                     sorted(t.location for t in album.tracks))
+                    for album in Album.query)
+    tracks = sorted((t.location, t.name, t.artist.name, t.length, t.size,
+                     t.mtime, t.inode, t.fingerprint) for t in Track.query)
+    artists = sorted((a.name, sorted(tag.name for tag in a.tags))
+                     for a in Artist.query)
+    tags = sorted(tag.name for tag in Tag.query)
+    return albums, tracks, artists, tags
+
+
+def rows(stats):
+    return dict((name, amount) for name, amount in stats.counters.items()
+                if name.startswith('rows.'))
+
+
+def test_parallel_parse_stores_the_same(library):
+    library.fill(artists=3, albums=2, tracks=4)
+
+    library.store()
+    stored = snapshot()
+    reset()
+    library.store(jobs=2)
+
+    assert snapshot() == stored
+
+
+def test_parallel_parse_reports_broken_files(library):
+    good = library.add(u'Artist', u'Album', u'Good')
+    broken = good.replace(u'Good', u'Broken')
+    with open(broken, 'w') as fh:
+        fh.write('{')
+
+    groups = list(cli.parse_groups([[good, broken]], jobs=2))
+
+    assert [[(path, error is None) for path, _, error in group]
+            for group in groups] == [[(good, True), (broken, False)]]
+
+
+@pytest.mark.parametrize('bulk', [False, True])
+def test_incremental_rescan_matches_full_store(library, bulk):
+    library.fill(artists=2, albums=2, tracks=3)
+    library.store(bulk=bulk)
+    # retag one track onto another artist's album, grow another one
+    moved = os.path.join(library.root, u'Artist 0', u'Album 0',
+                         u'01 Track.mp3')
+    library.write(moved, u'Artist 1', u'Album 1', u'01 Track', length=300)
+    library.add(u'Artist 1', u'Album 1', u'02 Track', length=200,
+                padding=50)
+    gone = os.path.join(library.root, u'Artist 1', u'Album 0',
+                        u'00 Track.mp3')
+    os.remove(gone)
+
+    library.store(incremental=True, bulk=bulk)
+    cli.prune_tracks(Track.query.filter_by(location=gone).all())
+    db.session.commit()
+    # a retagged track goes on the end of its new album
+    rescanned = snapshot(ordered=False)
+    reset()
+    library.store(bulk=bulk)
+
+    assert rescanned == snapshot(ordered=False)
+
+
+def test_unchanged_files_are_not_opened(library, monkeypatch):
+    library.fill(artists=1, albums=1, tracks=3)
+    library.store()
+    opened = []
+    monkeypatch.setattr(cli, 'File', lambda path, easy=True: opened.append(
+        path))
+
+    stats = library.store(incremental=True)
+
+    assert opened == []
+    assert stats.counters['files_seen'] == 3
+
+
+@pytest.mark.parametrize('batch', [1, 5, 500])
+def test_bulk_and_orm_store_the_same(library, monkeypatch, batch):
+    library.fill(artists=3, albums=2, tracks=4)
+    monkeypatch.setattr(cli, 'BULK_BATCH', batch)
+
+    library.store()
+    stored = snapshot()
+    reset()
+    library.store(bulk=True)
+
+    assert snapshot() == stored
+
+
+def test_batches_keep_their_groups():
+    groups = [cli.ParsedGroup([('a/1', {}, None)], seconds=1,
+                              counts={'parsed': 1}),
+              cli.ParsedGroup([('b/1', {}, None), ('b/2', None, 'bad')],
+                              seconds=2, counts={'parsed': 1, 'failed': 1}),
+              cli.ParsedGroup([('c/1', {}, None)], seconds=3,
+                              counts={'parsed': 1})]
+
+    batches = list(cli.batched_groups(groups, size=3))
+
+    assert [len(batch) for batch in batches] == [3, 1]
+    assert batches[0].groups == groups[:2]
+    assert batches[0].seconds == 3
+    assert batches[0].counts == {'parsed': 2, 'failed': 1}
+    assert batches[1].groups == groups[2:]
+
+
+def test_lean_store_stores_the_same(library):
+    library.fill(artists=3, albums=2, tracks=4)
+
+    library.store()
+    stored = snapshot()
+    reset()
+    library.store(lean=True)
+
+    assert snapshot() == stored
+
+
+def test_unique_cache_never_drops_pending_objects(app, monkeypatch):
+    monkeypatch.setattr(utils, 'UNIQUE_CACHE_SIZE', 2)
+
+    with db.session.no_autoflush:
+        artists = [Artist.find_or_create(db.session, name=name)
+                   for name in u'ABCDA']
+    db.session.commit()
+
+    assert artists[0] is artists[-1]
+    assert sorted(a.name for a in Artist.query) == [u'A', u'B', u'C', u'D']
+
+
+def test_parallel_parse_keeps_few_groups_in_flight(library):
+    paths = [library.add(u'Artist', u'Album {}'.format(n), u'Track')
+             for n in range(10)]
+    handed = []
+
+    def groups():
+        for path in paths:
+            handed.append(path)
+            yield [path]
+
+    parsed = cli.parse_groups(groups(), jobs=2)
+    next(parsed)
+
+    assert len(handed) == 2 * cli.IN_FLIGHT
+    assert len(list(parsed)) == len(paths) - 1
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_resume_skips_committed_directories(library, tmpdir, monkeypatch):
+    library.fill(artists=2, albums=2, tracks=2)
+    journal = str(tmpdir.join('journal'))
+    store_group = cli.store_group
+    stored = []
+
+    def interrupt_third(group, **kwargs):
+        if len(stored) == 2:
+            raise Interrupted()
+        stored.append(group)
+        return store_group(group, **kwargs)
+    monkeypatch.setattr(cli, 'store_group', interrupt_third)
+    with pytest.raises(Interrupted):
+        library.store(journal=journal)
+    db.session.rollback()
+    assert Track.query.count() == 4
+
+    stored[:] = []
+    monkeypatch.setattr(cli, 'store_group',
+                        lambda group, **kwargs: stored.append(group) or
+                        store_group(group, **kwargs))
+    library.store(journal=journal, resume=True)
+
+    assert len(stored) == 2
+    assert Track.query.count() == 8
+    assert not os.path.exists(journal)
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_scan_files_yields_what_filter_files_does(library, threads):
+    library.fill(artists=3, albums=3, tracks=2)
+    library.add(u'Artist 1', os.path.join(u'Album 1', u'Disc 2'), u'Track')
+    library.add(u'Artist 2', u'', u'Loose')
+    with open(os.path.join(library.root, u'Artist 0', u'cover.jpg'),
+              'w') as fh:
+        fh.write('not audio')
+
+    scanned = [list(group) for group in
+               cli.scan_files(library.root, threads=threads)]
+
+    assert scanned == list(cli.filter_files(library.root))
+
+
+def test_bulk_and_orm_count_the_same_rows(library):
+    library.fill(artists=3, albums=2, tracks=4)
+
+    orm = library.store(stats=IngestStats())
+    reset()
+    bulk = library.store(bulk=True, stats=IngestStats())
+
+    assert rows(bulk) == rows(orm)
+    assert rows(orm) == {'rows.artists': 3, 'rows.tags': 5,
+                         'rows.artisttags': 9, 'rows.tracklists': 6,
+                         'rows.album': 6, 'rows.tracks': 24,
+                         'rows.trackpositions': 24}
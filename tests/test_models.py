@@ -0,0 +1,79 @@
+import pytest
+from owa import db
+from owa.models import (Album, Playlist, Track, Tracklist, TrackPosition,
+                        refresh_counters)
+
+
+def counters():
+    return dict((t.id, (t.total_tracks, t.length)) for t in Tracklist.query)
+
+
+def counted():
+    """The counters worked out in SQL, from the positions themselves.
+    """
+    return dict((id, (count, length)) for id, count, length in
+                db.session.query(Tracklist.id, Tracklist.counted_tracks(),
+                                 Tracklist.summed_length()))
+
+
+@pytest.fixture
+def stored(library):
+    library.fill(artists=2, albums=2, tracks=3)
+    library.store()
+    return library
+
+
+def test_counters_follow_orm_changes(stored):
+    first, second = Album.query.order_by(Album.id).limit(2)
+    tracks = list(first.tracks)
+    playlist = Playlist(name=u'Mix', tracks=tracks[:2] + list(second.tracks))
+    db.session.add(playlist)
+    db.session.commit()
+
+    tracks[0].length = 1000
+    first.tracks.remove(tracks[1])
+    playlist.tracks.append(tracks[2])
+    db.session.commit()
+
+    assert counters() == counted()
+    assert counters()[playlist.id] == (6, 1000 + 181 + 543 + 182)
+
+
+def test_refresh_counters_recounts_in_sql(stored):
+    album = Album.query.first()
+    expected = counted()
+    table = Tracklist.__table__
+    db.session.execute(table.update().values(track_count=0, duration=0))
+    db.session.execute(TrackPosition.__table__.delete().where(
+        TrackPosition.track_id == album.tracks[0].id))
+
+    refresh_counters(db.session, [album.id])
+    db.session.commit()
+
+    assert counters()[album.id] == (2, 181 + 182)
+    refresh_counters(db.session)
+    db.session.commit()
+    expected[album.id] = (2, 181 + 182)
+    assert counters() == counted() == expected
+
+
+def test_hybrids_filter_and_order_in_sql(stored):
+    album = Album.query.first()
+    album.tracks.remove(album.tracks[0])
+    db.session.commit()
+
+    short = Tracklist.query.filter(Tracklist.total_tracks < 3).all()
+    longest = Tracklist.query.order_by(Tracklist.length.desc(),
+                                       Tracklist.id).first()
+
+    assert [t.id for t in short] == [album.id]
+    assert longest.length == max(t.length for t in Tracklist.query)
+    assert longest.id != album.id
+
+
+def test_changed_length_updates_its_tracklists(stored):
+    track = Track.query.first()
+    track.length += 20
+    db.session.commit()
+
+    assert counters() == counted()
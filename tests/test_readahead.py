@@ -0,0 +1,70 @@
+import io
+import os
+import pytest
+from owa import readahead
+from owa.models import Album
+from owa.utils import LRUCache
+
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+
+    def submit(self, *args):
+        self.calls.append(args)
+
+
+@pytest.fixture
+def song(tmpdir):
+    path = tmpdir.join('song.mp3')
+    path.write_binary(b'x' * 1000)
+    return str(path)
+
+
+def test_warm_asks_the_kernel(song, monkeypatch):
+    fadvise = Recorder()
+    monkeypatch.setattr(os, 'posix_fadvise', fadvise, raising=False)
+    monkeypatch.setattr(os, 'POSIX_FADV_WILLNEED', 3, raising=False)
+
+    readahead.warm(song, 100)
+
+    (fd, offset, length, advice), = fadvise.calls
+    assert (offset, length, advice) == (0, 100, 3)
+
+
+def test_warm_reads_without_fadvise(song, monkeypatch):
+    monkeypatch.delattr(os, 'posix_fadvise', raising=False)
+    monkeypatch.setattr(readahead, 'BLOCK_SIZE', 64)
+    reads = []
+
+    class Counting(io.FileIO):
+        def read(self, size=-1):
+            reads.append(size)
+            return super(Counting, self).read(size)
+    monkeypatch.setattr(readahead, 'open', Counting, raising=False)
+
+    readahead.warm(song, 100)
+
+    assert reads == [64, 36]
+
+
+def test_warm_ignores_missing_files(tmpdir):
+    readahead.warm(str(tmpdir.join('gone.mp3')))
+
+
+def test_read_ahead_hints_the_next_tracks_once(library, monkeypatch):
+    paths = [library.add(u'Artist', u'Album', u'{:02d}'.format(i))
+             for i in range(4)]
+    library.store()
+    album = Album.query.one()
+    executor = Recorder()
+    monkeypatch.setattr(readahead, '_executor', executor)
+    monkeypatch.setattr(readahead, '_hinted', LRUCache(4))
+
+    readahead.read_ahead(album.id, 0)
+    readahead.read_ahead(album.id, 0)
+
+    assert executor.calls == [(readahead.warm, path) for path in paths[1:3]]
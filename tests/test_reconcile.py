@@ -0,0 +1,108 @@
+import os
+import shutil
+import pytest
+from owa import db
+from owa.models import Track
+from owa.reconcile import find_missing, reconcile, relocate
+
+
+def locations():
+    return sorted(location for location, in
+                  Track.query.with_entities(Track.location))
+
+
+def test_prune_stays_inside_roots(library):
+    kept = library.add(u'Elsewhere', u'Album', u'Gone')
+    lost = library.add(u'Here', u'Album', u'Gone')
+    library.add(u'Here', u'Album', u'Stays')
+    library.store()
+    os.remove(kept)
+    os.remove(lost)
+
+    moved, gone = reconcile([os.path.join(library.root, u'Here')],
+                            prune=True)
+
+    assert moved == []
+    assert [track.location for track in gone] == [lost]
+    assert lost not in locations()
+    assert kept in locations()
+
+
+def test_prune_treats_roots_literally(library):
+    # _ is a LIKE wildcard, Band_1 mustn't reach into BandX1
+    wild = library.add(u'Band_1', u'Album', u'Gone')
+    other = library.add(u'BandX1', u'Album', u'Gone')
+    library.store()
+    os.remove(wild)
+    os.remove(other)
+
+    _, gone = reconcile([os.path.join(library.root, u'Band_1')], prune=True)
+
+    assert [track.location for track in gone] == [wild]
+    assert other in locations()
+
+
+def test_moved_files_are_relocated(library):
+    old = library.add(u'Artist', u'Album', u'Track', padding=10)
+    library.store()
+    new = os.path.join(library.root, u'Artist', u'Renamed')
+    shutil.move(os.path.dirname(old), new)
+
+    moved, gone = reconcile([library.root], prune=True)
+
+    assert gone == []
+    assert [(track.location, location) for track, location in moved] == \
+        [(old, os.path.join(new, u'Track.mp3'))]
+    assert locations() == [os.path.join(new, u'Track.mp3')]
+
+
+def test_find_missing_by_prefix(library):
+    path = library.add(u'Artist', u'Album', u'Track')
+    library.store()
+    os.remove(path)
+
+    assert find_missing(prefixes=[os.path.join(library.root, u'Other')]) == []
+    assert [m.location for m in find_missing()] == [path]
+
+
+@pytest.mark.parametrize('roots', [None, []])
+def test_roots_are_required(app, roots):
+    with pytest.raises(ValueError):
+        reconcile(roots)
+
+
+def forget_fingerprints():
+    Track.query.update({'fingerprint': None, 'size': None})
+    db.session.commit()
+
+
+def test_tracks_without_fingerprints_are_matched_by_tags(library):
+    old = library.add(u'Artist', u'Album', u'Track', length=200)
+    other = library.add(u'Artist', u'Album', u'Other', length=200)
+    library.store()
+    forget_fingerprints()
+    new = os.path.join(library.root, u'Artist', u'Moved')
+    shutil.move(os.path.dirname(old), new)
+    # same artist and length, only the name tells them apart
+    os.remove(os.path.join(new, u'Other.mp3'))
+
+    moved, gone = reconcile([library.root], prune=True)
+
+    assert [(t.location, path) for t, path in moved] == \
+        [(old, os.path.join(new, u'Track.mp3'))]
+    assert [t.location for t in gone] == [other]
+    track = Track.query.one()
+    assert track.location == os.path.join(new, u'Track.mp3')
+    assert track.fingerprint and track.size
+
+
+def test_vanished_candidates_are_skipped(library):
+    old = library.add(u'Artist', u'Album', u'Track')
+    library.store()
+    new = os.path.join(library.root, u'Moved.mp3')
+    shutil.move(old, new)
+
+    moved, gone = relocate(find_missing(), [new + u'.gone', new])
+
+    assert [path for _, path in moved] == [new]
+    assert gone == []
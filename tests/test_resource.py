@@ -0,0 +1,161 @@
+import json
+import pytest
+from sqlalchemy import event
+from owa import db
+from owa.models import Artist, Revision, Track
+from owa.resource import cursor_value_fits
+from owa.utils import encode_cursor
+
+
+@pytest.fixture
+def stored(library):
+    library.fill(artists=2, albums=1, tracks=3)
+    library.store()
+    return library
+
+
+def get(client, url):
+    response = client.get(url)
+    return response.status_code, json.loads(response.data.decode('utf-8'))
+
+
+def test_revision_is_bumped_once_per_commit(stored):
+    number, _ = Revision.current()
+
+    Artist.query.first().name = u'Renamed'
+    db.session.flush()
+    db.session.add(Artist(name=u'New'))
+    db.session.flush()
+    db.session.commit()
+
+    assert Revision.current()[0] == number + 1
+
+
+def test_rolled_back_changes_dont_bump_the_revision(stored):
+    number, _ = Revision.current()
+
+    db.session.add(Artist(name=u'New'))
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+
+    assert Revision.current()[0] == number
+
+
+def test_bulk_store_bumps_the_revision(library):
+    library.fill(artists=1, albums=1, tracks=2)
+    library.store(bulk=True)
+
+    assert Revision.current()[0] == 1
+
+
+def test_current_revision_gets_not_modified(client, stored):
+    response = client.get('/track/')
+    etag = response.headers['ETag']
+
+    cached = client.get('/track/', headers={'If-None-Match': etag})
+
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == etag
+    assert not cached.data
+
+
+def test_changes_invalidate_the_etag(client, stored):
+    etag = client.get('/track/').headers['ETag']
+    Artist.query.first().name = u'Renamed'
+    db.session.commit()
+
+    response = client.get('/track/', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_cursor_pages_through_everything(client, stored):
+    seen, url = [], '/track/?limit=4'
+    while url:
+        status, data = get(client, url)
+        assert status == 200
+        seen.extend(track['id'] for track in data['tracks'])
+        url = data['next'] and '/track/?limit=4&cursor=' + data['next']
+    assert seen == list(range(1, 7))
+
+
+@pytest.mark.parametrize('cursor', [
+    encode_cursor(u'3'),
+    encode_cursor(True),
+    encode_cursor(None),
+    encode_cursor(1.5),
+    encode_cursor(2, 3),
+    encode_cursor(),
+    'not a cursor',
+])
+def test_bad_cursor_is_rejected(client, stored, cursor):
+    status, data = get(client, '/track/?cursor=' + cursor)
+    assert status == 400
+    assert data == {'error': 'invalid cursor'}
+
+
+def test_cursor_value_fits_column_types(app):
+    assert cursor_value_fits(Artist.name, u'Artist')
+    assert not cursor_value_fits(Artist.name, 1)
+    assert cursor_value_fits(Track.id, 1)
+    assert not cursor_value_fits(Track.id, u'1')
+    assert not cursor_value_fits(Track.id, False)
+
+
+def test_fields_narrow_a_list(client, stored):
+    status, data = get(client, '/track/?fields=name,id')
+    assert status == 200
+    assert all(sorted(track) == ['id', 'name'] for track in data['tracks'])
+
+
+@pytest.mark.parametrize('url', [
+    # not in ListTracks' only
+    '/track/?fields=id,tracklists',
+    '/track/?fields=links',
+    # not in ListArtists' only
+    '/artist/?fields=albums',
+    '/track/?fields=nope',
+])
+def test_fields_stay_inside_the_schema(client, stored, url):
+    status, data = get(client, url)
+    assert status == 400
+    assert 'unknown fields' in data['error']
+
+
+def test_fields_narrow_a_single_item(client, stored):
+    status, data = get(client, '/track/1/?fields=id,uuid')
+    assert status == 200
+    assert sorted(data) == ['id', 'uuid']
+
+
+def test_fields_add_a_column_left_out_of_a_list(client, stored):
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        status, data = get(client, '/track/?fields=id,name,uuid')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    assert status == 200
+    assert all(sorted(track) == ['id', 'name', 'uuid']
+               for track in data['tracks'])
+    selects = [s for s in statements if 'FROM tracks' in s]
+    assert len(selects) == 1
+    assert 'location' not in selects[0] and 'JOIN' not in selects[0]
+
+
+def test_ids_come_back_in_order(client, stored):
+    status, data = get(client, '/track/?ids=3,99,1&fields=id')
+    assert status == 200
+    assert data == {'tracks': [{'id': 3}, None, {'id': 1}], 'missing': [99]}
+
+
+@pytest.mark.parametrize('ids', ['1,x', ','.join(map(str, range(101)))])
+def test_bad_ids_are_rejected(client, stored, ids):
+    status, _ = get(client, '/track/?ids=' + ids)
+    assert status == 400
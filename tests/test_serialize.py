@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from inspect import isclass
+import pytest
+from marshmallow.fields import List, Nested
+from owa import db
+from owa.api import album, artist, playlist, tag, track
+from owa.models import Playlist, Track
+from owa.resource import OWAResource
+from owa.serialize import dump
+
+RESOURCES = sorted((cls for module in (album, artist, playlist, tag, track)
+                    for cls in vars(module).values()
+                    if isclass(cls) and issubclass(cls, OWAResource) and
+                    getattr(cls, 'model', None) is not None),
+                   key=lambda cls: cls.__name__)
+
+
+def narrowings(schema):
+    """The resource's own only, then a few narrower ones.
+    """
+    nested = tuple(name for name, field in schema.fields.items()
+                   if type(field) in (List, Nested))
+    return [schema.only, ('id', 'links'), ('id',) + nested]
+
+
+@pytest.fixture
+def stored(library):
+    library.add(u'Motörhead', u'Ace of Spädes', u'Über', genres=(u'métal',))
+    library.add(u'Motörhead', u'Ace of Spädes', u'Ça va',
+                genres=(u'métal', u'rock'))
+    library.add(u'Björk', u'Homogénic', u'Jóga', genres=(u'électro',))
+    library.store()
+    db.session.add(Playlist(name=u'Mélange', tracks=Track.query.all()))
+    db.session.commit()
+
+
+@pytest.mark.parametrize('resource', RESOURCES,
+                         ids=[cls.__name__ for cls in RESOURCES])
+def test_compiled_dump_matches_schema_dump(app, stored, resource):
+    items = resource.model.query.order_by(resource.model.id).all()
+    schema_class = type(resource.schema)
+
+    with app.test_request_context():
+        for only in narrowings(resource.schema):
+            for many in (False, True):
+                schema = schema_class(many=many, only=only)
+                objs = [items] if many else items
+                for obj in objs * 2:
+                    assert dump(schema, obj) == schema.dump(obj).data
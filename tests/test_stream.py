@@ -0,0 +1,167 @@
+import io
+import os
+import pytest
+from owa import db, transcode
+from owa.models import Track
+from owa.stream import find_stream
+
+
+@pytest.fixture
+def track(library):
+    path = library.add(u'Artist', u'Album', u'Track', padding=1000)
+    library.store()
+    track = Track.query.one()
+    with io.open(path, 'rb') as fh:
+        return track.uuid, fh.read()
+
+
+def test_whole_file(client, track):
+    uuid, data = track
+    response = client.get('/stream/' + uuid)
+    assert response.status_code == 200
+    assert response.data == data
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+@pytest.mark.parametrize('header, start, stop', [
+    ('bytes=0-9', 0, 10),
+    ('bytes=10-', 10, None),
+    ('bytes=-10', -10, None),
+    ('bytes=5-100000', 5, None),
+])
+def test_range(client, track, header, start, stop):
+    uuid, data = track
+    response = client.get('/stream/' + uuid, headers={'Range': header})
+    part = data[start:stop]
+    first = start % len(data)
+    assert response.status_code == 206
+    assert response.data == part
+    assert response.headers['Content-Range'] == 'bytes {}-{}/{}'.format(
+        first, first + len(part) - 1, len(data))
+
+
+def test_unsatisfiable_range(client, track):
+    uuid, data = track
+    response = client.get('/stream/' + uuid,
+                          headers={'Range': 'bytes={}-'.format(len(data))})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */{}'.format(
+        len(data))
+
+
+def test_stale_if_range_gets_everything(client, track):
+    uuid, data = track
+    response = client.get('/stream/' + uuid, headers={'Range': 'bytes=0-9',
+                                                      'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == data
+
+
+def test_etag_gets_not_modified(client, track):
+    uuid, _ = track
+    etag = client.get('/stream/' + uuid).headers['ETag']
+    response = client.get('/stream/' + uuid,
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_cached_streams_skip_the_database(track, monkeypatch):
+    uuid, _ = track
+    found, _ = find_stream(uuid)
+    monkeypatch.setattr(db.session, 'query', None)
+
+    assert find_stream(uuid)[0] == found
+
+
+def test_moved_file_is_looked_up_again(library, track):
+    uuid, data = track
+    found, _ = find_stream(uuid)
+    moved = found.location.replace(u'Track.mp3', u'Moved.mp3')
+    os.rename(found.location, moved)
+    # behind the cache's back, as a reconcile in another process would
+    Track.query.update({'location': moved})
+    db.session.commit()
+
+    assert find_stream(uuid)[0].location == moved
+
+
+def test_rewritten_file_is_stat_again(library, track):
+    uuid, data = track
+    found, _ = find_stream(uuid)
+    library.write(found.location, u'Artist', u'Album', u'Track', padding=5)
+
+    refound, stat = find_stream(uuid)
+
+    assert refound.size == stat.st_size == os.path.getsize(found.location)
+    assert refound.size != found.size
+
+
+class Missing(transcode.FFmpegTranscoder):
+    executable = os.path.join(os.sep, 'nowhere', 'ffmpeg')
+
+
+class Broken(transcode.PassThrough):
+    def transcode(self, location, format, bitrate):
+        raise transcode.TranscodeError('unsupported')
+
+
+@pytest.mark.parametrize('transcoder, status', [(Missing, 503),
+                                                (Broken, 501)])
+def test_transcode_failing_to_start(app, client, track, tmpdir, transcoder,
+                                    status):
+    app.config.update(TRANSCODER=transcoder,
+                      TRANSCODE_CACHE_DIR=str(tmpdir.mkdir('cache')))
+    uuid, _ = track
+    response = client.get('/stream/{}?format=mp3'.format(uuid))
+    assert response.status_code == status
+
+
+class Watched(transcode.PassThrough):
+    """Notes what's in the cache directory while the output is read.
+    """
+    listings = []
+
+    def transcode(self, location, format, bitrate):
+        directory = transcode.current_transcoder()[1].directory
+        chunks = super(Watched, self).transcode(location, format, bitrate)
+        for chunk in chunks:
+            self.listings.append(os.listdir(directory))
+            yield chunk
+
+
+def test_transcode_is_cached_once_finished(app, client, track, tmpdir,
+                                           monkeypatch):
+    cache = tmpdir.mkdir('cache')
+    app.config.update(TRANSCODER=Watched, TRANSCODE_CACHE_DIR=str(cache))
+    monkeypatch.setattr(Watched, 'listings', [])
+    uuid, data = track
+    url = '/stream/{}?format=mp3'.format(uuid)
+
+    first = client.get(url)
+
+    assert first.data == data
+    assert Watched.listings
+    assert all(len(names) == 1 and names[0].endswith('.part')
+               for names in Watched.listings)
+    assert [os.path.splitext(name)[1] for name in cache.listdir()] == [
+        '.mp3']
+
+    monkeypatch.setattr(Watched, 'transcode', None)
+    second = client.get(url, headers={'Range': 'bytes=0-9'})
+
+    assert second.status_code == 206
+    assert second.data == data[:10]
+    assert second.headers['ETag'] == first.headers['ETag']
+
+
+def test_transcodes_are_keyed_by_transcoder_and_settings():
+    stat = os.stat(__file__)
+    ffmpeg = transcode.FFmpegTranscoder()
+
+    def key(transcoder):
+        return transcode.TranscodeCache.key(
+            'uuid', stat, 'mp3', 128, transcoder.settings('mp3', 128))
+
+    assert key(transcode.PassThrough()) != key(ffmpeg)
+    assert key(ffmpeg) != key(Missing())
+    assert key(ffmpeg) == key(transcode.FFmpegTranscoder())
@@ -0,0 +1,102 @@
+import sys
+import threading
+import pytest
+from owa.models import Track
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 5),
+                                reason='the stream server needs asyncio')
+
+
+@pytest.fixture
+def server(app, library, request):
+    import asyncio
+    from owa.streamserver import StreamServer
+    path = library.add(u'Artist', u'Album', u'Track', padding=1000)
+    library.store()
+    with open(path, 'rb') as fh:
+        data = fh.read()
+
+    streams = StreamServer(app, lookups=2, idle=5)
+    loop = asyncio.new_event_loop()
+    listening = loop.run_until_complete(asyncio.start_server(
+        streams.handle, '127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        listening.close()
+        loop.run_until_complete(listening.wait_closed())
+        loop.close()
+        streams.executor.shutdown()
+    request.addfinalizer(stop)
+
+    port = listening.sockets[0].getsockname()[1]
+    return port, '/stream/' + Track.query.one().uuid, data
+
+
+@pytest.fixture
+def connection(server, request):
+    from http.client import HTTPConnection
+    connection = HTTPConnection('127.0.0.1', server[0], timeout=5)
+    request.addfinalizer(connection.close)
+    return connection
+
+
+def fetch(connection, url, method='GET', headers=None, body=None):
+    connection.request(method, url, body=body, headers=headers or {})
+    response = connection.getresponse()
+    return response.status, dict(response.getheaders()), response.read()
+
+
+def test_whole_file(server, connection):
+    _, url, data = server
+    status, headers, body = fetch(connection, url)
+    assert status == 200
+    assert body == data
+    assert headers['Accept-Ranges'] == 'bytes'
+
+
+def test_range(server, connection):
+    _, url, data = server
+    status, headers, body = fetch(connection, url,
+                                  headers={'Range': 'bytes=10-19'})
+    assert status == 206
+    assert body == data[10:20]
+    assert headers['Content-Range'] == 'bytes 10-19/{}'.format(len(data))
+
+
+def test_etag_gets_not_modified(server, connection):
+    _, url, _ = server
+    _, headers, _ = fetch(connection, url, method='HEAD')
+    status, _, body = fetch(connection, url,
+                            headers={'If-None-Match': headers['ETag']})
+    assert status == 304
+    assert body == b''
+
+
+def test_connection_is_kept_alive(server, connection):
+    _, url, data = server
+    fetch(connection, url, headers={'Range': 'bytes=0-9'})
+    sock = connection.sock
+
+    status, _, body = fetch(connection, url)
+
+    assert connection.sock is sock
+    assert (status, body) == (200, data)
+
+
+def test_request_body_is_skipped(server, connection):
+    _, url, data = server
+    status, _, _ = fetch(connection, url, method='POST',
+                         body=b'GET /nowhere HTTP/1.1\r\n\r\n' * 100)
+    sock = connection.sock
+
+    assert status == 405
+    assert fetch(connection, url)[::2] == (200, data)
+    assert connection.sock is sock
+
+
+def test_missing_stream(server, connection):
+    assert fetch(connection, '/stream/nope')[0] == 404
@@ -0,0 +1,89 @@
+import io
+import os
+import pytest
+from owa import cli
+from owa.tagcache import TagCache
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return str(tmpdir.join('tags.db'))
+
+
+@pytest.fixture
+def opened(library, monkeypatch):
+    opened = []
+    open_file = cli.File
+
+    def recording(path, easy=True):
+        opened.append(path)
+        return open_file(path, easy)
+    monkeypatch.setattr(cli, 'File', recording)
+    return opened
+
+
+def parse(path, cache):
+    group = cli.parse_group([path], cache=cache)
+    (_, info, error), = group
+    return info, error, group.counts
+
+
+def test_get_checks_size_and_mtime(cache):
+    tags = TagCache(cache)
+    tags.put_many([(u'/a.mp3', 10, 100, {'name': u'A'}, None),
+                   (u'/b.mp3', 20, 200, None, u'Error ValueError: bad')])
+
+    assert tags.get(u'/a.mp3', 10, 100) == ({'name': u'A'}, None)
+    assert tags.get(u'/b.mp3', 20, 200) == (None, u'Error ValueError: bad')
+    assert tags.get(u'/a.mp3', 11, 100) is None
+    assert tags.get(u'/a.mp3', 10, 101) is None
+    assert tags.get(u'/c.mp3', 10, 100) is None
+
+
+def test_unchanged_files_are_read_from_cache(library, cache, opened):
+    path = library.add(u'Artist', u'Album', u'Track')
+
+    first = parse(path, cache)
+    second = parse(path, cache)
+
+    assert opened == [path]
+    assert second[:2] == first[:2]
+    assert second[2]['cache_hits'] == 1
+    assert second[2]['parsed'] == 0
+
+
+def test_changed_size_is_a_miss(library, cache, opened):
+    path = library.add(u'Artist', u'Album', u'Track')
+    parse(path, cache)
+    library.write(path, u'Artist', u'Album', u'Retitled', padding=10)
+
+    info, _, counts = parse(path, cache)
+
+    assert opened == [path, path]
+    assert info['name'] == u'Retitled'
+    assert counts['cache_hits'] == 0
+
+
+def test_changed_mtime_is_a_miss(library, cache, opened):
+    path = library.add(u'Artist', u'Album', u'Track')
+    parse(path, cache)
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+    _, _, counts = parse(path, cache)
+
+    assert opened == [path, path]
+    assert counts['parsed'] == 1
+
+
+def test_failures_are_cached(library, cache, opened):
+    path = os.path.join(library.root, u'broken.mp3')
+    with io.open(path, 'w') as fh:
+        fh.write(u'{')
+
+    first = parse(path, cache)
+    second = parse(path, cache)
+
+    assert opened == [path]
+    assert second[1] == first[1] and first[1]
+    assert second[2]['failed'] == 1
@@ -0,0 +1,108 @@
+import io
+import os
+import pytest
+from owa import watch as watching
+from owa.models import Track
+
+
+class Stop(Exception):
+    pass
+
+
+class FakeWatcher(object):
+    """Reports each batch of changes once, then stops the watch.
+    """
+
+    def __init__(self, *batches):
+        self.polls = []
+        for batch in batches:
+            # an empty poll in between lets the batch settle
+            self.polls.extend([set(batch), set()])
+
+    def poll(self, timeout):
+        if not self.polls:
+            raise Stop()
+        return self.polls.pop(0)
+
+
+def names():
+    return sorted(name for name, in Track.query.with_entities(Track.name))
+
+
+def test_corrupt_file_is_skipped(library, capsys):
+    library.add(u'Artist', u'Album', u'Good')
+    corrupt = os.path.join(library.root, u'Artist', u'Album', u'Bad.mp3')
+    with io.open(corrupt, 'wb') as fh:
+        fh.write(b'\x00 not really audio')
+
+    watcher = FakeWatcher([(library.root, True)])
+    with pytest.raises(Stop):
+        watching.watch([library.root], watcher=watcher)
+
+    assert names() == [u'Good']
+    assert 'Bad.mp3' in capsys.readouterr()[1]
+
+
+def test_watch_survives_a_failed_sync(library, monkeypatch):
+    first = os.path.join(library.root, u'First')
+    second = os.path.join(library.root, u'Second')
+    library.add(u'First', u'Album', u'One')
+    library.add(u'Second', u'Album', u'Two')
+    sync = watching.sync_directory
+
+    def flaky(directory, *args, **kwargs):
+        if directory == first:
+            raise RuntimeError('disk went away')
+        return sync(directory, *args, **kwargs)
+    monkeypatch.setattr(watching, 'sync_directory', flaky)
+
+    watcher = FakeWatcher([(first, True), (second, True)],
+                          [(second, False)])
+    with pytest.raises(Stop):
+        watching.watch([library.root], watcher=watcher)
+
+    assert names() == [u'Two']
+
+
+def test_sync_prunes_deleted_files(library):
+    gone = library.add(u'Artist', u'Album', u'Gone')
+    library.add(u'Artist', u'Album', u'Stays')
+    library.store()
+    os.remove(gone)
+
+    watching.sync_directory(os.path.dirname(gone), recursive=False)
+
+    assert names() == [u'Stays']
+
+
+@pytest.fixture
+def polling(library, monkeypatch):
+    monkeypatch.setattr(watching, 'sleep', lambda seconds: None)
+    return watching.PollingWatcher([library.root], interval=0)
+
+
+def test_polling_waits_for_files_to_stop_changing(library, polling):
+    path = library.add(u'Artist', u'Album', u'Track')
+    album = os.path.dirname(path)
+
+    assert (os.path.dirname(album), True) in polling.poll(0)
+    with io.open(path, 'ab') as fh:
+        fh.write(b' still copying')
+    assert polling.poll(0) == set([(album, False)])
+    assert polling.poll(0) == set()
+
+
+def test_polling_survives_a_vanished_directory(library, polling,
+                                               monkeypatch):
+    album = os.path.dirname(library.add(u'Artist', u'Album', u'Track'))
+    polling.poll(0)
+    listdir = os.listdir
+
+    def gone(directory):
+        if directory == album:
+            raise OSError('gone')
+        return listdir(directory)
+    monkeypatch.setattr(os, 'listdir', gone)
+    library.add(u'Artist', u'Album', u'Another')
+
+    assert (album, False) in polling.poll(0)